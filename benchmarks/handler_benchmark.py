@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Drives the light handlers with synthetic mqtt traffic on simulated hardware and reports command throughput,
+I2C writes per fade and command-to-first-write latency.
+
+Run from the project root: python -m benchmarks.handler_benchmark
+"""
+
+import argparse
+import bisect
+import logging
+import random
+import time
+
+from core.command_dispatcher import CommandDispatcher
+from core.fade_scheduler import FadeScheduler
+from core.pi_pwm import PiPwm, BoardConfig, CHANNELS_PER_BOARD
+from core.pwm_backend import BACKEND_SIMULATED, get_written_channels
+from core.topic_trie import TopicTrie
+from handlers.color_light_handler import ColorLightHandler
+
+BASE_TOPIC = "benchmark/lights"
+CHANNELS_PER_LIGHT = 3
+VALUE_RANGE = 255
+
+
+class SyntheticMqttConnector:
+    """Stand-in for MqttConnector, delivering injected messages through the command dispatcher like the real
+    connector does for messages received from the broker."""
+
+    def __init__(self, dispatcher: CommandDispatcher):
+        self.__dispatcher = dispatcher
+        self.__topic_trie = TopicTrie()
+        self.published_messages = []
+
+    def subscribe_to_topic(self, topic, callback, merge_function=None):
+        self.__topic_trie.add(topic, callback)
+        if merge_function is not None:
+            self.__dispatcher.set_merge_function(topic, merge_function)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published_messages.append((topic, payload, qos, retain))
+
+    def inject(self, topic: str, payload: str):
+        handlers = self.__topic_trie.match(topic)
+        self.__dispatcher.dispatch(topic, payload.encode("utf-8"), handlers)
+
+
+class BenchmarkSetup:
+    def __init__(self, light_count: int, fade_duration: float, write_delay: float):
+        lights_per_board = CHANNELS_PER_BOARD // CHANNELS_PER_LIGHT
+        board_count = (light_count + lights_per_board - 1) // lights_per_board
+        board_configs = [BoardConfig("board" + str(i), 0x40 + i, busnum=1, backend=BACKEND_SIMULATED)
+                         for i in range(board_count)]
+
+        self.dispatcher = CommandDispatcher()
+        self.connector = SyntheticMqttConnector(self.dispatcher)
+        self.pwm = PiPwm(board_configs)
+        self.fade_scheduler = FadeScheduler(self.pwm)
+        for board in self.pwm.get_boards():
+            board.get_backend().set_write_delay(write_delay)
+
+        self.lights = []
+        for i in range(light_count):
+            board_index, slot = divmod(i, lights_per_board)
+            channel_ids = tuple(board_index * CHANNELS_PER_BOARD + slot * CHANNELS_PER_LIGHT + c
+                                for c in range(CHANNELS_PER_LIGHT))
+            light_id = "light" + str(i)
+            handler = ColorLightHandler(self.connector, self.pwm, self.fade_scheduler, mqtt_basetopic=BASE_TOPIC,
+                                        id=light_id, channel_ids=channel_ids, value_range=VALUE_RANGE,
+                                        fade_duration=fade_duration)
+            self.lights.append((light_id, channel_ids, handler))
+
+    def send(self, light_id: str, suffix: str, payload: str):
+        self.connector.inject(BASE_TOPIC + "/" + light_id + "/" + suffix, payload)
+
+    def wait_until_dispatched(self, timeout: float = 30.0):
+        deadline = time.monotonic() + timeout
+        while self.dispatcher.get_queue_depth() > 0:
+            if time.monotonic() > deadline:
+                raise TimeoutError("Commands were not dispatched")
+            time.sleep(0.0005)
+
+    def wait_until_idle(self, timeout: float = 30.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.dispatcher.get_queue_depth() == 0 and not any(h.is_fading() for _, _, h in self.lights):
+                # give the bus writers time to flush the last frame
+                time.sleep(0.05)
+                return
+            time.sleep(0.005)
+        raise TimeoutError("Handlers did not become idle")
+
+    def get_transactions(self):
+        """Return all recorded transactions as (timestamp, global channel ids) sorted by timestamp."""
+        transactions = []
+        for board_index, board in enumerate(self.pwm.get_boards()):
+            for timestamp, register, data in board.get_backend().get_transactions():
+                channels = tuple(board_index * CHANNELS_PER_BOARD + c for c in get_written_channels(register, data))
+                if channels:
+                    transactions.append((timestamp, channels))
+        return sorted(transactions)
+
+    def clear_transactions(self):
+        for board in self.pwm.get_boards():
+            board.get_backend().clear_transactions()
+
+
+def percentile(sorted_values: list, fraction: float):
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def turn_on_all(setup: BenchmarkSetup):
+    for light_id, _, _ in setup.lights:
+        setup.send(light_id, "color", "255;255;255")
+        setup.send(light_id, "brightness", str(VALUE_RANGE))
+        setup.send(light_id, "power", "ON")
+    setup.wait_until_idle()
+    setup.clear_transactions()
+
+
+def benchmark_writes_per_fade(setup: BenchmarkSetup):
+    turn_on_all(setup)
+    for light_id, _, _ in setup.lights:
+        setup.send(light_id, "brightness", "0")
+    setup.wait_until_idle()
+    transactions = setup.get_transactions()
+    return len(transactions) / len(setup.lights)
+
+
+def benchmark_throughput(setup: BenchmarkSetup, command_count: int):
+    turn_on_all(setup)
+    start = time.monotonic()
+    for i in range(command_count):
+        light_id = setup.lights[i % len(setup.lights)][0]
+        setup.send(light_id, "brightness", str(random.randint(0, VALUE_RANGE)))
+    setup.wait_until_dispatched()
+    throughput = command_count / (time.monotonic() - start)
+    setup.wait_until_idle()
+    return throughput
+
+
+def benchmark_latency(setup: BenchmarkSetup, command_count: int, interval: float):
+    turn_on_all(setup)
+    commands = []
+    brightness = 0
+    for i in range(command_count):
+        light_id, channel_ids, _ = random.choice(setup.lights)
+        brightness = (brightness + 97) % (VALUE_RANGE + 1)
+        commands.append((time.monotonic(), set(channel_ids)))
+        setup.send(light_id, "brightness", str(brightness))
+        time.sleep(interval)
+    setup.wait_until_idle()
+
+    transactions = setup.get_transactions()
+    timestamps = [timestamp for timestamp, _ in transactions]
+    latencies = []
+    for sent_at, channel_ids in commands:
+        for timestamp, channels in transactions[bisect.bisect_left(timestamps, sent_at):]:
+            if channel_ids.intersection(channels):
+                latencies.append(timestamp - sent_at)
+                break
+    return sorted(latencies)
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argument_parser.add_argument("--lights", type=int, default=5, help="number of simulated color lights")
+    argument_parser.add_argument("--commands", type=int, default=1000, help="commands per benchmark")
+    argument_parser.add_argument("--interval", type=float, default=0.01,
+                                 help="seconds between commands in the latency benchmark")
+    argument_parser.add_argument("--fade-duration", type=float, default=0.3, help="fade duration in seconds")
+    argument_parser.add_argument("--write-delay", type=float, default=0.0003,
+                                 help="simulated duration of one I2C transaction in seconds")
+    arguments = argument_parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    setup = BenchmarkSetup(arguments.lights, arguments.fade_duration, arguments.write_delay)
+
+    writes_per_fade = benchmark_writes_per_fade(setup)
+    throughput = benchmark_throughput(setup, arguments.commands)
+    latencies = benchmark_latency(setup, min(arguments.commands, 200), arguments.interval)
+    statistics = setup.dispatcher.get_statistics()
+
+    print("lights:                 {}".format(arguments.lights))
+    print("I2C writes per fade:    {:.1f}".format(writes_per_fade))
+    print("commands/sec:           {:.0f}".format(throughput))
+    print("coalesced commands:     {} of {}".format(statistics["coalesced"], statistics["received"]))
+    print("latency p50/p90/p99/max: {:.2f} / {:.2f} / {:.2f} / {:.2f} ms".format(
+        *(1000 * percentile(latencies, fraction) for fraction in (0.5, 0.9, 0.99, 1.0))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Replays a recorded mqtt command trace against a config on simulated hardware and reports command latency and
+I2C write statistics. Optionally the final channel values are compared with an expected state file.
+
+Traces are recorded by setting the trace_file option in the general section of the config.
+
+Run from the project root: python -m benchmarks.trace_replay trace.jsonl.gz --config config.ini
+"""
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+import paho.mqtt.client as mqtt
+
+import main as service
+from core.pi_pwm import CHANNELS_PER_BOARD, command_to_output_latency, i2c_write_duration
+from core.pwm_backend import BACKEND_SIMULATED, get_written_channels
+from core.trace_recorder import read_trace
+
+GENERAL_OVERRIDES = {
+    "backend": BACKEND_SIMULATED,
+    "output_process": "false",
+    "state_file": "",
+    "trace_file": "",
+    "metrics_port": None,
+}
+
+
+class LoopbackMessageInfo:
+    rc = mqtt.MQTT_ERR_SUCCESS
+
+
+class LoopbackClient:
+    """In-process stand-in for the paho client and the broker. Injected messages are delivered to the connector if
+    they match one of its subscriptions, published messages are collected."""
+
+    instances = []
+
+    def __init__(self, transport=None, protocol=None):
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.published_messages = []
+        self.__subscriptions = set()
+        LoopbackClient.instances.append(self)
+
+    def tls_set(self, *args, **kwargs):
+        pass
+
+    def connect_async(self, host, port=1883, *args, **kwargs):
+        pass
+
+    def loop_start(self):
+        self.on_connect(self, None, {"session present": 0}, 0)
+
+    def subscribe(self, topic, qos=0, *args, **kwargs):
+        topics = topic if isinstance(topic, list) else [(topic, qos)]
+        self.__subscriptions.update(subscription_filter for subscription_filter, _ in topics)
+        return mqtt.MQTT_ERR_SUCCESS, 0
+
+    def unsubscribe(self, topic, *args, **kwargs):
+        self.__subscriptions.difference_update(topic if isinstance(topic, list) else [topic])
+        return mqtt.MQTT_ERR_SUCCESS, 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self.published_messages.append((topic, payload, qos, retain))
+        return LoopbackMessageInfo()
+
+    def deliver(self, topic: str, payload: bytes):
+        if any(mqtt.topic_matches_sub(subscription_filter, topic) for subscription_filter in self.__subscriptions):
+            message = mqtt.MQTTMessage(topic=topic.encode("utf-8"))
+            message.payload = payload
+            self.on_message(self, None, message)
+
+
+def replay(trace_filename: str, client: LoopbackClient, speed: float):
+    """Deliver the messages of the trace, keeping their relative timing scaled by speed (0 replays as fast as
+    possible). Returns the number of messages and the replay duration."""
+    message_count = 0
+    start_time = time.monotonic()
+    for offset, topic, payload in read_trace(trace_filename):
+        if speed > 0:
+            delay = start_time + offset / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        client.deliver(topic, payload)
+        message_count += 1
+    return message_count, time.monotonic() - start_time
+
+
+def wait_until_idle(settle_time: float, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    devices = service.device_registry.get_devices().values()
+    while time.monotonic() < deadline:
+        if service.command_dispatcher.get_queue_depth() == 0 and \
+                not any(device.is_fading() for device in devices if hasattr(device, "is_fading")):
+            # give the bus writers time to flush the last frame
+            time.sleep(settle_time)
+            return
+        time.sleep(0.01)
+    raise TimeoutError("Devices did not become idle")
+
+
+def get_channel_values():
+    channel_count = len(service.pwm.get_boards()) * CHANNELS_PER_BOARD
+    return {str(channel_id): service.pwm.get_pwm_channel_value(channel_id) for channel_id in range(channel_count)}
+
+
+def count_transactions():
+    transaction_count = 0
+    channel_write_count = 0
+    for board in service.pwm.get_boards():
+        for _, register, data in board.get_backend().get_transactions():
+            written_channels = get_written_channels(register, data)
+            if written_channels:
+                transaction_count += 1
+                channel_write_count += len(written_channels)
+    return transaction_count, channel_write_count
+
+
+def compare_channel_values(channel_values: dict, expected_values: dict):
+    """Return the (channel id, expected, actual) tuples of all channels whose value differs from the expectation."""
+    return [(channel_id, expected_value, channel_values.get(channel_id))
+            for channel_id, expected_value in sorted(expected_values.items(), key=lambda item: int(item[0]))
+            if channel_values.get(channel_id) != expected_value]
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argument_parser.add_argument("trace", help="trace file recorded via the trace_file option")
+    argument_parser.add_argument("--config", default=service.CONFIG_FILENAME, help="config file defining the devices")
+    argument_parser.add_argument("--speed", type=float, default=1.0,
+                                 help="replay speed factor, 1 is real time, 0 replays as fast as possible")
+    argument_parser.add_argument("--settle-time", type=float, default=0.2,
+                                 help="seconds to wait for the last writes after all fades finished")
+    argument_parser.add_argument("--expected", help="json file with the expected final value of each channel")
+    argument_parser.add_argument("--write-expected", help="write the final channel values to this json file")
+    arguments = argument_parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    service.initialize(arguments.config, client_factory=LoopbackClient, general_overrides=GENERAL_OVERRIDES)
+    for board in service.pwm.get_boards():
+        board.get_backend().clear_transactions()
+
+    client = LoopbackClient.instances[-1]
+    message_count, duration = replay(arguments.trace, client, arguments.speed)
+    wait_until_idle(arguments.settle_time)
+
+    transaction_count, channel_write_count = count_transactions()
+    statistics = service.command_dispatcher.get_statistics()
+    print("messages:                {} in {:.2f} s".format(message_count, duration))
+    print("coalesced commands:      {} of {}".format(statistics["coalesced"], statistics["received"]))
+    print("latency p50/p90/p99:     <= {:.1f} / {:.1f} / {:.1f} ms".format(
+        *(1000 * command_to_output_latency.get_percentile(fraction) for fraction in (0.5, 0.9, 0.99))))
+    print("I2C transactions:        {} ({} channel writes)".format(transaction_count, channel_write_count))
+    if i2c_write_duration.get_count():
+        print("I2C write time mean:     {:.3f} ms".format(
+            1000 * i2c_write_duration.get_sum() / i2c_write_duration.get_count()))
+    print("published messages:      {}".format(len(client.published_messages)))
+
+    channel_values = get_channel_values()
+    if arguments.write_expected:
+        with open(arguments.write_expected, "w") as file:
+            json.dump(channel_values, file, indent=2)
+        print("final channel values written to '{}'".format(arguments.write_expected))
+
+    if arguments.expected:
+        with open(arguments.expected, "r") as file:
+            expected_values = json.load(file)
+        mismatches = compare_channel_values(channel_values, expected_values)
+        for channel_id, expected_value, actual_value in mismatches:
+            print("channel {}: expected {}, got {}".format(channel_id, expected_value, actual_value))
+        print("final channel states:    {}".format("mismatch" if mismatches else "ok"))
+        if mismatches:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
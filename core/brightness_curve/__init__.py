@@ -0,0 +1,92 @@
+from functools import lru_cache
+
+from utils import logarithmic_fade
+
+CURVE_EXPONENTIAL = "exponential"
+CURVE_CIE1931 = "cie1931"
+CURVE_GAMMA = "gamma"
+CURVE_CALIBRATION = "calibration"
+
+DEFAULT_EXPONENTIAL_BASE = 5
+DEFAULT_GAMMA = 2.2
+
+TABLE_MAX_VALUE = 4095
+
+
+class BrightnessCurve:
+    """Integer lookup table mapping a linear brightness value (0..4095) to the pwm value which is written to the
+    channel."""
+
+    def __init__(self, name: str, table: tuple):
+        self.__name = name
+        self.__table = table
+
+    def get_name(self):
+        return self.__name
+
+    def get_table(self):
+        return self.__table
+
+    def map(self, value: int):
+        return self.__table[value]
+
+
+def create_curve(curve_type: str = CURVE_EXPONENTIAL, base: float = DEFAULT_EXPONENTIAL_BASE,
+                 gamma: float = DEFAULT_GAMMA, calibration_points: () = None):
+    if curve_type == CURVE_EXPONENTIAL:
+        return _exponential_curve(float(base))
+    if curve_type == CURVE_CIE1931:
+        return _cie1931_curve()
+    if curve_type == CURVE_GAMMA:
+        return _gamma_curve(float(gamma))
+    if curve_type == CURVE_CALIBRATION:
+        if not calibration_points:
+            raise ValueError("Calibration curve requires at least one calibration point.")
+        return _calibration_curve(tuple(sorted((int(x), int(y)) for x, y in calibration_points)))
+    raise ValueError("Unknown brightness curve '" + str(curve_type) + "'.")
+
+
+@lru_cache(maxsize=None)
+def _exponential_curve(base: float):
+    return BrightnessCurve(CURVE_EXPONENTIAL, _build_table(
+        lambda x: logarithmic_fade(x, TABLE_MAX_VALUE, TABLE_MAX_VALUE, base)))
+
+
+@lru_cache(maxsize=None)
+def _cie1931_curve():
+    def cie1931(x):
+        lightness = 100.0 * x / TABLE_MAX_VALUE
+        if lightness <= 8:
+            luminance = lightness / 903.3
+        else:
+            luminance = ((lightness + 16) / 116.0) ** 3
+        return luminance * TABLE_MAX_VALUE
+
+    return BrightnessCurve(CURVE_CIE1931, _build_table(cie1931))
+
+
+@lru_cache(maxsize=None)
+def _gamma_curve(gamma: float):
+    return BrightnessCurve(CURVE_GAMMA, _build_table(lambda x: (x / TABLE_MAX_VALUE) ** gamma * TABLE_MAX_VALUE))
+
+
+@lru_cache(maxsize=None)
+def _calibration_curve(points: ()):
+    if points[0][0] > 0:
+        points = ((0, 0),) + points
+    if points[-1][0] < TABLE_MAX_VALUE:
+        points = points + ((TABLE_MAX_VALUE, TABLE_MAX_VALUE),)
+
+    def interpolate(x):
+        for (x0, y0), (x1, y1) in zip(points, points[1:]):
+            if x <= x1:
+                if x1 == x0:
+                    return y1
+                return y0 + (y1 - y0) * (x - x0) / (x1 - x0)
+        return points[-1][1]
+
+    return BrightnessCurve(CURVE_CALIBRATION, _build_table(interpolate))
+
+
+def _build_table(function):
+    return tuple(min(TABLE_MAX_VALUE, max(0, int(function(x)))) for x in range(0, TABLE_MAX_VALUE + 1))
@@ -0,0 +1,90 @@
+import logging
+import time
+from collections import OrderedDict
+from threading import Thread, Condition
+
+from core.metrics import REGISTRY, set_command_received_time
+
+commands_coalesced = REGISTRY.counter("dispatcher_commands_coalesced_total",
+                                      "Number of commands superseded by a newer one")
+commands_failed = REGISTRY.counter("dispatcher_commands_failed_total", "Number of commands whose handling failed")
+
+
+class CommandDispatcher:
+    """Decouples handler callbacks from the mqtt network thread. Commands are queued per topic (and therefore per
+    device and command type), so a command which has not been applied yet is superseded by a newer one on the
+    same topic and only the latest payload gets handled. Topics with a merge function combine the pending payload
+    with the newer one instead, for commands which only carry the fields they change."""
+
+    def __init__(self):
+        self.__pending_commands = OrderedDict()
+        self.__merge_functions = {}
+        self.__condition = Condition()
+
+        self.__received_count = 0
+        self.__coalesced_count = 0
+        self.__failed_count = 0
+
+        REGISTRY.gauge("dispatcher_queue_depth", "Number of commands waiting to be dispatched").set_function(
+            self.get_queue_depth)
+
+        self.__worker_thread = Thread(target=self.__dispatch_worker, daemon=True)
+        self.__worker_thread.start()
+
+        logging.debug("CommandDispatcher created")
+
+    def dispatch(self, topic: str, payload, callbacks: (), received_time: float = None):
+        if received_time is None:
+            received_time = time.monotonic()
+        with self.__condition:
+            self.__received_count += 1
+            if topic in self.__pending_commands:
+                self.__coalesced_count += 1
+                commands_coalesced.inc()
+                pending_payload = self.__pending_commands.pop(topic)[0]
+                merge_function = self.__merge_functions.get(topic)
+                if merge_function is not None:
+                    payload = merge_function(pending_payload, payload)
+                logging.debug("Coalesced pending command on topic '%s'", topic)
+            self.__pending_commands[topic] = (payload, callbacks, received_time)
+            self.__condition.notify()
+
+    def set_merge_function(self, topic: str, merge_function):
+        """Set the function combining a pending payload of the topic with a newer one. It gets called with the
+        pending and the new payload and returns the payload to handle. None restores latest-wins."""
+        with self.__condition:
+            if merge_function is None:
+                self.__merge_functions.pop(topic, None)
+            else:
+                self.__merge_functions[topic] = merge_function
+
+    def get_queue_depth(self):
+        with self.__condition:
+            return len(self.__pending_commands)
+
+    def get_statistics(self):
+        with self.__condition:
+            return {
+                "received": self.__received_count,
+                "coalesced": self.__coalesced_count,
+                "failed": self.__failed_count,
+                "pending": len(self.__pending_commands),
+            }
+
+    def __dispatch_worker(self):
+        while True:
+            with self.__condition:
+                while not self.__pending_commands:
+                    self.__condition.wait()
+                topic, (payload, callbacks, received_time) = self.__pending_commands.popitem(last=False)
+
+            set_command_received_time(received_time)
+            for callback in callbacks:
+                try:
+                    callback(payload)
+                except Exception:
+                    with self.__condition:
+                        self.__failed_count += 1
+                    commands_failed.inc()
+                    logging.exception("Failed to handle command on topic '%s'", topic)
+            set_command_received_time(None)
@@ -0,0 +1,129 @@
+import json
+import math
+
+MQTT_MESSAGE_ON = "ON"
+MQTT_MESSAGE_OFF = "OFF"
+
+FIELD_STATE = "state"
+FIELD_BRIGHTNESS = "brightness"
+FIELD_COLOR = "color"
+FIELD_TRANSITION = "transition"
+FIELD_EFFECT = "effect"
+COLOR_COMPONENTS = ("r", "g", "b", "w")
+
+
+class SetCommand:
+    """Combined state change parsed from a json set command. Brightness and color components are fractions between
+    0 and 1, the transition is given in seconds. Fields which are not part of the command are None."""
+
+    __slots__ = ("power", "brightness", "color", "transition", "effect")
+
+    def __init__(self, power: bool = None, brightness: float = None, color: () = None, transition: float = None,
+                 effect: str = None):
+        self.power = power
+        self.brightness = brightness
+        self.color = color
+        self.transition = transition
+        self.effect = effect
+
+
+def parse_power(payload) -> bool:
+    state = _decode(payload).strip().upper()
+    if state == MQTT_MESSAGE_ON:
+        return True
+    if state == MQTT_MESSAGE_OFF:
+        return False
+    raise ValueError("Invalid power state '" + state + "', must be ON or OFF.")
+
+
+def parse_brightness(payload, value_range: int) -> float:
+    """Parse a brightness given in the value range of the device. Returns a fraction between 0 and 1."""
+    return _to_fraction(_to_number(_decode(payload).strip()), value_range)
+
+
+def parse_color(payload, value_range: int) -> ():
+    """Parse a color in the format 'r;g;b' with components in the value range of the device. Returns the components
+    as fractions between 0 and 1."""
+    return tuple(_to_fraction(_to_number(value.strip()), value_range) for value in _decode(payload).split(";"))
+
+
+def parse_effect(payload) -> str:
+    effect = _decode(payload).strip()
+    if not effect:
+        raise ValueError("Effect must not be empty.")
+    return effect
+
+
+def parse_set_command(payload, value_range: int) -> SetCommand:
+    """Parse a Home Assistant style json command, e.g. '{"state": "ON", "brightness": 80, "color": {"r": 255,
+    "g": 120, "b": 0}, "transition": 2, "effect": "none"}'. Brightness and color components are given in the value
+    range of the device, colors can also be given as list."""
+    try:
+        document = json.loads(payload)
+    except ValueError as error:
+        raise ValueError("Invalid json: " + str(error))
+    if not isinstance(document, dict):
+        raise ValueError("Set command must be a json object.")
+
+    command = SetCommand()
+    if document.get(FIELD_STATE) is not None:
+        command.power = parse_power(str(document[FIELD_STATE]))
+    if document.get(FIELD_BRIGHTNESS) is not None:
+        command.brightness = _to_fraction(_to_number(document[FIELD_BRIGHTNESS]), value_range)
+    if document.get(FIELD_COLOR) is not None:
+        command.color = _parse_color_value(document[FIELD_COLOR], value_range)
+    if document.get(FIELD_TRANSITION) is not None:
+        command.transition = _to_number(document[FIELD_TRANSITION])
+        if command.transition < 0:
+            raise ValueError("Transition must not be negative.")
+    if document.get(FIELD_EFFECT) is not None:
+        command.effect = parse_effect(str(document[FIELD_EFFECT]))
+    return command
+
+
+def merge_set_payloads(pending_payload, payload):
+    """Combine two json set commands into one, fields of the newer command take precedence. Used to coalesce set
+    commands, which only carry the fields they change, without losing fields of the pending one. If one of the
+    payloads is not a json object, the newer payload is returned unchanged."""
+    try:
+        pending_document = json.loads(pending_payload)
+        document = json.loads(payload)
+    except (TypeError, ValueError):
+        return payload
+    if not isinstance(pending_document, dict) or not isinstance(document, dict):
+        return payload
+    pending_document.update(document)
+    return json.dumps(pending_document, separators=(",", ":"))
+
+
+def _parse_color_value(color, value_range: int) -> ():
+    if isinstance(color, dict):
+        components = [color[component] for component in COLOR_COMPONENTS if component in color]
+        if len(components) != len(color):
+            raise ValueError("Color components must be out of " + ", ".join(COLOR_COMPONENTS) + ".")
+    elif isinstance(color, list):
+        components = color
+    else:
+        raise ValueError("Color must be a json object or list.")
+    return tuple(_to_fraction(_to_number(component), value_range) for component in components)
+
+
+def _decode(payload) -> str:
+    return payload.decode("utf-8") if isinstance(payload, (bytes, bytearray)) else str(payload)
+
+
+def _to_number(value) -> float:
+    if isinstance(value, bool):
+        raise ValueError("Expected a number, got '" + str(value) + "'.")
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError("Expected a number, got '" + str(value) + "'.")
+    if not math.isfinite(number):
+        raise ValueError("Expected a finite number, got '" + str(value) + "'.")
+    return number
+
+
+def _to_fraction(value: float, value_range: int) -> float:
+    """Scale a value of the given range to a fraction, values outside of the range are clamped."""
+    return min(max(value / value_range, 0.0), 1.0)
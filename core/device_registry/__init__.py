@@ -0,0 +1,35 @@
+import logging
+
+
+class DeviceRegistry:
+    """Maps device types to factories and keeps track of the created devices by name. A factory is called as
+    factory(device_name, options) and returns the created device."""
+
+    def __init__(self):
+        self.__factories = {}
+        self.__devices = {}
+
+    def register_type(self, device_type: str, factory):
+        self.__factories[device_type] = factory
+
+    def get_types(self):
+        return tuple(self.__factories.keys())
+
+    def create_device(self, device_name: str, device_type: str, options):
+        factory = self.__factories.get(device_type)
+        if factory is None:
+            logging.warning("Unknown type '%s' of device '%s'", device_type, device_name)
+            return None
+
+        device = factory(device_name, options)
+        self.__devices[device_name] = device
+        return device
+
+    def remove_device(self, device_name: str):
+        return self.__devices.pop(device_name, None)
+
+    def get_device(self, device_name: str):
+        return self.__devices.get(device_name)
+
+    def get_devices(self):
+        return dict(self.__devices)
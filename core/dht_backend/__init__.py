@@ -0,0 +1,59 @@
+import logging
+import math
+import random
+import time
+
+BACKEND_HARDWARE = "hardware"
+BACKEND_SIMULATED = "simulated"
+
+SENSOR_DHT11 = "DHT11"
+SENSOR_DHT22 = "DHT22"
+SENSOR_AM2302 = "AM2302"
+SENSOR_TYPES = {
+    SENSOR_DHT11: 11,
+    SENSOR_DHT22: 22,
+    SENSOR_AM2302: 22,
+}
+
+
+class DhtBackend:
+    """Real DHT sensor, read via the Adafruit driver. A read is a single attempt without the driver's blocking
+    retries, retrying is up to the caller."""
+
+    def __init__(self, sensor_type: str, pin: int):
+        import Adafruit_DHT
+
+        self.__dht = Adafruit_DHT
+        self.__sensor = SENSOR_TYPES[sensor_type]
+        self.__pin = pin
+
+    def read(self):
+        """Return (humidity, temperature), both None if the read failed."""
+        return self.__dht.read(self.__sensor, self.__pin)
+
+
+class SimulatedDhtBackend:
+    """Simulated DHT sensor, returning slowly drifting values. A share of the reads fails like on real sensors."""
+
+    def __init__(self, sensor_type: str, pin: int, failure_rate: float = 0.2):
+        self.__pin = pin
+        self.__failure_rate = failure_rate
+        self.__random = random.Random(pin)
+        logging.debug("Simulated %s created on gpio %d", sensor_type, pin)
+
+    def read(self):
+        if self.__random.random() < self.__failure_rate:
+            return None, None
+        phase = time.monotonic() / 600.0
+        return 45.0 + 5.0 * math.sin(phase), 21.0 + 1.5 * math.cos(phase)
+
+
+def create_dht_backend(backend: str, sensor_type: str, pin: int):
+    if sensor_type not in SENSOR_TYPES:
+        raise ValueError("Unknown dht sensor type '" + str(sensor_type) + "', must be one of " +
+                         ", ".join(SENSOR_TYPES) + ".")
+    if backend == BACKEND_HARDWARE:
+        return DhtBackend(sensor_type, pin)
+    if backend == BACKEND_SIMULATED:
+        return SimulatedDhtBackend(sensor_type, pin)
+    raise ValueError("Unknown dht backend '" + str(backend) + "'.")
@@ -0,0 +1,231 @@
+import logging
+import time
+from threading import Thread, Condition
+
+from core.pi_pwm import PiPwm
+from core.brightness_curve import TABLE_MAX_VALUE
+
+EFFECT_BREATHING = "breathing"
+EFFECT_RAINBOW = "rainbow"
+EFFECT_CANDLE = "candle"
+EFFECT_STROBE = "strobe"
+EFFECT_CHASE = "chase"
+EFFECT_NONE = "none"
+
+DEFAULT_EFFECT_FRAME_RATE = 30
+
+BREATHING_PERIOD = 4.0
+RAINBOW_PERIOD = 10.0
+CANDLE_SMOOTHING = 0.6
+CANDLE_MIN_LEVEL = 0.6
+STROBE_FREQUENCY = 5.0
+STROBE_DUTY_CYCLE = 0.5
+CHASE_SPEED = 8.0
+CHASE_WIDTH = 2.0
+
+# NumPy is imported with the first effect, see EffectsEngine
+np = None
+
+
+def import_numpy():
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+
+
+class EffectInstance:
+    def __init__(self, effect: str, channel_ids: (), base_values: (), output_table: (), start_time: float):
+        self.effect = effect
+        self.channel_ids = channel_ids
+        self.base_values = base_values
+        self.output_table = output_table
+        self.start_time = start_time
+        # linear values of the last frame written, a fade replacing the effect starts from them
+        self.last_values = None
+
+
+class EffectFrameState:
+    """Flat arrays over all channels of all active effects, rebuilt whenever the set of active effects changes."""
+
+    def __init__(self, instances: dict):
+        channel_ids = []
+        base_values = []
+        light_levels = []
+        start_times = []
+        channel_indices = []
+        effect_names = []
+        table_indices = []
+        tables = []
+        table_ids = {}
+        # (key, instance, first index, end index) of each effect within the flat arrays
+        self.entries = []
+        for key, instance in instances.items():
+            self.entries.append((key, instance, len(channel_ids), len(channel_ids) + len(instance.channel_ids)))
+            if id(instance.output_table) not in table_ids:
+                table_ids[id(instance.output_table)] = len(tables)
+                tables.append(instance.output_table if instance.output_table is not None
+                              else range(0, TABLE_MAX_VALUE + 1))
+            light_level = max(instance.base_values) if instance.base_values else 0
+            for channel_index, (channel_id, base_value) in enumerate(zip(instance.channel_ids, instance.base_values)):
+                channel_ids.append(channel_id)
+                base_values.append(base_value)
+                light_levels.append(light_level)
+                start_times.append(instance.start_time)
+                channel_indices.append(channel_index)
+                effect_names.append(instance.effect)
+                table_indices.append(table_ids[id(instance.output_table)])
+
+        self.channel_ids = channel_ids
+        self.base_values = np.array(base_values, dtype=np.float64)
+        self.light_levels = np.array(light_levels, dtype=np.float64)
+        self.start_times = np.array(start_times, dtype=np.float64)
+        self.channel_indices = np.array(channel_indices, dtype=np.int64)
+        self.effect_masks = {effect: np.array([name == effect for name in effect_names], dtype=bool)
+                             for effect in set(effect_names)}
+        self.chase_positions = np.cumsum(self.effect_masks.get(EFFECT_CHASE, np.zeros(len(channel_ids), bool))) - 1
+        self.chase_length = max(1, int(self.effect_masks.get(EFFECT_CHASE, np.zeros(0, bool)).sum()))
+        self.flicker = np.ones(len(channel_ids), dtype=np.float64)
+        # one row per output table, channels pick their row via table_indices
+        self.tables = np.array(tables, dtype=np.int64)
+        self.table_indices = np.array(table_indices, dtype=np.int64)
+
+
+class EffectsEngine:
+    """Renders continuous light effects. Each frame is computed for all channels of all active effects at once as
+    NumPy arrays and written as one batch of pwm updates. NumPy and the render thread are only loaded when the first
+    effect starts, so setups which never use effects do not pay for them on startup."""
+
+    EFFECTS = (EFFECT_BREATHING, EFFECT_RAINBOW, EFFECT_CANDLE, EFFECT_STROBE, EFFECT_CHASE)
+
+    def __init__(self, pwm: PiPwm, frame_rate: float = DEFAULT_EFFECT_FRAME_RATE):
+        self.__pwm = pwm
+        self.__frame_interval = 1.0 / frame_rate
+        self.__instances = {}
+        self.__frame_state = None
+        self.__condition = Condition()
+        self.__random = None
+        self.__render_thread = None
+
+        logging.debug("EffectsEngine created")
+
+    def start(self, key, effect: str, channel_ids: (), base_values: (), output_table: ()):
+        """Start (or update) the effect owned by key. The base values are the linear channel values (0..4095) the
+        effect is modulating. Updating the base values of a running effect keeps its phase."""
+        if effect not in self.EFFECTS:
+            raise ValueError("Unknown effect '" + str(effect) + "'.")
+
+        with self.__condition:
+            if self.__render_thread is None:
+                self.__start_render_thread()
+            previous = self.__instances.get(key)
+            start_time = previous.start_time if previous is not None and previous.effect == effect \
+                else time.monotonic()
+            instance = EffectInstance(effect, tuple(channel_ids), tuple(base_values), output_table, start_time)
+            if previous is not None:
+                instance.last_values = previous.last_values
+            self.__instances[key] = instance
+            self.__frame_state = None
+            self.__condition.notify()
+
+    def stop(self, key):
+        """Stop the effect owned by key. Returns the linear channel values of its last frame, or None if no frame
+        was written. No frame of the effect is written after stop returns."""
+        with self.__condition:
+            instance = self.__instances.pop(key, None)
+            if instance is None:
+                return None
+            self.__frame_state = None
+            return instance.last_values
+
+    def is_running(self, key):
+        with self.__condition:
+            return key in self.__instances
+
+    def __start_render_thread(self):
+        import_numpy()
+        self.__random = np.random.default_rng()
+        self.__render_thread = Thread(target=self.__render_loop, daemon=True)
+        self.__render_thread.start()
+        logging.debug("EffectsEngine render thread started")
+
+    def __render_loop(self):
+        next_frame_time = time.monotonic()
+        while True:
+            with self.__condition:
+                while not self.__instances:
+                    self.__condition.wait()
+                    next_frame_time = time.monotonic()
+                if self.__frame_state is None:
+                    self.__frame_state = EffectFrameState(self.__instances)
+                frame_state = self.__frame_state
+
+            linear_values, output_values = self.__compute_frame(frame_state, time.monotonic())
+            with self.__condition:
+                # start and stop replace the frame state, a frame computed for a replaced state is dropped, so it
+                # cannot overwrite what the owner of a stopped effect writes next
+                if self.__frame_state is frame_state:
+                    self.__write_frame(frame_state, linear_values.tolist(), output_values.tolist())
+
+            next_frame_time += self.__frame_interval
+            delay = next_frame_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_frame_time = time.monotonic()
+
+    def __write_frame(self, frame_state: EffectFrameState, linear_values: list, output_values: list):
+        try:
+            self.__pwm.set_pwm_channel_values(dict(zip(frame_state.channel_ids, output_values)), ())
+        except IndexError:
+            # an effect with invalid channels must not stop the effects of all other lights, so write them one by
+            # one and drop the failing effects
+            for key, instance, first, end in frame_state.entries:
+                try:
+                    self.__pwm.set_pwm_channel_values(dict(zip(instance.channel_ids, output_values[first:end])), ())
+                except IndexError as error:
+                    logging.error("Dropping effect '%s' on channels %s: %s", instance.effect,
+                                  list(instance.channel_ids), error)
+                    del self.__instances[key]
+                    self.__frame_state = None
+        for _, instance, first, end in frame_state.entries:
+            instance.last_values = tuple(linear_values[first:end])
+
+    def __compute_frame(self, state: EffectFrameState, now: float):
+        elapsed = now - state.start_times
+        values = np.zeros(len(state.channel_ids), dtype=np.float64)
+
+        mask = state.effect_masks.get(EFFECT_BREATHING)
+        if mask is not None:
+            level = 0.5 - 0.5 * np.cos(2 * np.pi * elapsed[mask] / BREATHING_PERIOD)
+            values[mask] = state.base_values[mask] * level
+
+        mask = state.effect_masks.get(EFFECT_RAINBOW)
+        if mask is not None:
+            hue = (elapsed[mask] / RAINBOW_PERIOD) % 1.0
+            # hsv to rgb with full saturation: red, green and blue are offset by a third of the hue circle
+            offsets = np.choose(np.minimum(state.channel_indices[mask], 3), (0.0, 4.0, 2.0, 0.0))
+            component = np.clip(np.abs((hue * 6 + offsets) % 6 - 3) - 1, 0, 1)
+            component[state.channel_indices[mask] > 2] = 0
+            values[mask] = state.light_levels[mask] * component
+
+        mask = state.effect_masks.get(EFFECT_CANDLE)
+        if mask is not None:
+            noise = self.__random.uniform(CANDLE_MIN_LEVEL, 1.0, int(mask.sum()))
+            state.flicker[mask] = CANDLE_SMOOTHING * state.flicker[mask] + (1 - CANDLE_SMOOTHING) * noise
+            values[mask] = state.base_values[mask] * state.flicker[mask]
+
+        mask = state.effect_masks.get(EFFECT_STROBE)
+        if mask is not None:
+            on = ((elapsed[mask] * STROBE_FREQUENCY) % 1.0) < STROBE_DUTY_CYCLE
+            values[mask] = np.where(on, state.base_values[mask], 0)
+
+        mask = state.effect_masks.get(EFFECT_CHASE)
+        if mask is not None:
+            head = (elapsed[mask] * CHASE_SPEED) % state.chase_length
+            distance = np.abs(state.chase_positions[mask] - head)
+            distance = np.minimum(distance, state.chase_length - distance)
+            values[mask] = state.base_values[mask] * np.clip(1 - distance / CHASE_WIDTH, 0, 1)
+
+        linear_values = np.clip(values, 0, TABLE_MAX_VALUE).astype(np.int64)
+        return linear_values, state.tables[state.table_indices, linear_values]
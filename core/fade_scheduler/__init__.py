@@ -0,0 +1,170 @@
+import logging
+import time
+from contextlib import contextmanager
+from threading import Thread, Condition
+
+from core.pi_pwm import PiPwm
+from core.brightness_curve import TABLE_MAX_VALUE
+from core.metrics import REGISTRY, get_command_received_time
+
+frame_jitter = REGISTRY.histogram("fade_frame_jitter_seconds", "Delay of fade frames behind their schedule")
+active_transitions = REGISTRY.gauge("fade_active_transitions", "Number of running transitions")
+
+DEFAULT_FADE_DURATION = 0.3
+DEFAULT_FRAME_RATE = 50
+
+
+class Transition:
+    def __init__(self, channel_ids: (), initial_values: (), target_values: (), duration: float, start_time: float,
+                 output_table: (), on_frame):
+        self.channel_ids = channel_ids
+        self.initial_values = initial_values
+        self.diff_values = tuple(min(TABLE_MAX_VALUE, max(0, target)) - initial
+                                 for initial, target in zip(initial_values, target_values))
+        self.duration = duration
+        self.start_time = start_time
+        self.output_table = output_table
+        self.initial_output_values = self.map_output(initial_values)
+        self.on_frame = on_frame
+        self.progress = 0.0
+        self.command_received_time = get_command_received_time()
+
+    def advance(self, now: float):
+        if self.duration <= 0:
+            self.progress = 1.0
+        else:
+            self.progress = min(1.0, (now - self.start_time) / self.duration)
+        return tuple(int(initial + self.progress * diff)
+                     for initial, diff in zip(self.initial_values, self.diff_values))
+
+    def map_output(self, values: ()):
+        if self.output_table is None:
+            return tuple(values)
+        return tuple(self.output_table[value] for value in values)
+
+    def is_finished(self):
+        return self.progress >= 1.0
+
+
+class FadeScheduler:
+    """Central render loop which advances all active transitions in a single tick and writes one batch of pwm
+    updates per frame. Transitions are interpolated against a monotonic clock, so frames are dropped instead of
+    stretching the fade when the loop falls behind."""
+
+    def __init__(self, pwm: PiPwm, frame_rate: float = DEFAULT_FRAME_RATE):
+        self.__pwm = pwm
+        self.__frame_interval = 1.0 / frame_rate
+        self.__transitions = {}
+        self.__condition = Condition()
+        self.__batch_start_time = None
+
+        self.__render_thread = Thread(target=self.__render_loop, daemon=True)
+        self.__render_thread.start()
+
+        logging.debug("FadeScheduler created")
+
+    def fade(self, key, channel_ids: (), initial_values: (), target_values: (), duration: float = DEFAULT_FADE_DURATION,
+             output_table: () = None, on_frame=None):
+        """Register (or retarget) the transition owned by key. A running transition with the same key is replaced.
+        If given, the output table maps the interpolated values to the pwm values written to the channels."""
+        with self.__condition:
+            start_time = self.__batch_start_time if self.__batch_start_time is not None else time.monotonic()
+            transition = Transition(channel_ids, initial_values, target_values, duration, start_time,
+                                    output_table, on_frame)
+            self.__transitions[key] = transition
+            active_transitions.set(len(self.__transitions))
+            self.__condition.notify()
+
+    @contextmanager
+    def batch(self):
+        """Register all fades started within the context atomically and with a common start time, so they are
+        rendered in lockstep and their register updates are flushed in the same frame."""
+        with self.__condition:
+            outermost = self.__batch_start_time is None
+            if outermost:
+                self.__batch_start_time = time.monotonic()
+            try:
+                yield
+            finally:
+                if outermost:
+                    self.__batch_start_time = None
+
+    def cancel(self, key):
+        with self.__condition:
+            self.__transitions.pop(key, None)
+            active_transitions.set(len(self.__transitions))
+
+    def is_fading(self, key):
+        with self.__condition:
+            return key in self.__transitions
+
+    def __render_loop(self):
+        next_frame_time = time.monotonic()
+        while True:
+            with self.__condition:
+                while not self.__transitions:
+                    self.__condition.wait()
+                    next_frame_time = time.monotonic()
+                now = time.monotonic()
+                frame_jitter.observe(now - next_frame_time)
+                frame = self.__tick(now)
+
+            self.__write_frame(frame)
+            with self.__condition:
+                # finished transitions are only removed once their final values are written
+                for key, transition, _, _ in frame:
+                    if transition.is_finished() and self.__transitions.get(key) is transition:
+                        del self.__transitions[key]
+                active_transitions.set(len(self.__transitions))
+
+            next_frame_time += self.__frame_interval
+            delay = next_frame_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # fell behind, skip the missed frames instead of catching up
+                next_frame_time = time.monotonic()
+
+    def __tick(self, now: float):
+        """Advance all transitions. Returns one (key, transition, channel values, command received time) entry per
+        transition."""
+        frame = []
+        for key, transition in self.__transitions.items():
+            current = transition.advance(now)
+            output_values = transition.map_output(current)
+
+            # the latency is tracked up to the first frame which actually changes the output
+            command_received_time = None
+            if transition.command_received_time is not None and \
+                    (output_values != transition.initial_output_values or transition.is_finished()):
+                command_received_time = transition.command_received_time
+                transition.command_received_time = None
+            if transition.on_frame is not None:
+                transition.on_frame(current)
+            frame.append((key, transition, dict(zip(transition.channel_ids, output_values)), command_received_time))
+        return frame
+
+    def __write_frame(self, frame: ()):
+        channel_values = {}
+        command_received_times = []
+        for _, _, transition_values, command_received_time in frame:
+            channel_values.update(transition_values)
+            if command_received_time is not None:
+                command_received_times.append(command_received_time)
+        try:
+            self.__pwm.set_pwm_channel_values(channel_values, command_received_times)
+            return
+        except IndexError:
+            pass
+
+        # a transition with invalid channels must not cost all other lights their frame, so write them one by one
+        # and drop the failing transitions
+        for key, transition, transition_values, command_received_time in frame:
+            try:
+                self.__pwm.set_pwm_channel_values(transition_values,
+                                                  () if command_received_time is None else (command_received_time,))
+            except IndexError as error:
+                logging.error("Dropping transition on channels %s: %s", list(transition.channel_ids), error)
+                with self.__condition:
+                    if self.__transitions.get(key) is transition:
+                        del self.__transitions[key]
@@ -0,0 +1,75 @@
+import logging
+import time
+from threading import Thread, Lock
+
+BACKEND_HARDWARE = "hardware"
+BACKEND_SIMULATED = "simulated"
+
+
+class ScriptedGpio:
+    """Stand-in for the RPi.GPIO module. Input levels are set programmatically or played back from a script of
+    (delay, pin, level) steps, triggering the registered edge callbacks like the real module does."""
+
+    BCM = 11
+    IN = 1
+    BOTH = 33
+
+    def __init__(self, edge_detection: bool = True):
+        self.__edge_detection = edge_detection
+        self.__levels = {}
+        self.__callbacks = {}
+        self.__lock = Lock()
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin: int, direction):
+        with self.__lock:
+            self.__levels.setdefault(pin, 0)
+
+    def add_event_detect(self, pin: int, edge, callback=None, bouncetime=None):
+        if not self.__edge_detection:
+            raise RuntimeError("Failed to add edge detection")
+        with self.__lock:
+            self.__callbacks[pin] = callback
+
+    def remove_event_detect(self, pin: int):
+        with self.__lock:
+            self.__callbacks.pop(pin, None)
+
+    def input(self, pin: int):
+        with self.__lock:
+            return self.__levels.get(pin, 0)
+
+    def set_input(self, pin: int, level: bool):
+        with self.__lock:
+            changed = self.__levels.get(pin, 0) != int(level)
+            self.__levels[pin] = int(level)
+            callback = self.__callbacks.get(pin)
+        if changed and callback is not None:
+            callback(pin)
+
+    def play(self, script: ()):
+        """Play back the (delay, pin, level) steps of a script in a background thread."""
+        thread = Thread(target=self.__play_script, args=(script,), daemon=True)
+        thread.start()
+        return thread
+
+    def __play_script(self, script: ()):
+        for delay, pin, level in script:
+            time.sleep(delay)
+            self.set_input(pin, level)
+
+
+def create_gpio_backend(backend: str):
+    if backend == BACKEND_HARDWARE:
+        try:
+            import RPi.GPIO as GPIO
+        except RuntimeError:
+            logging.error("Error importing RPi.GPIO! This is probably because you need superuser privileges. You can "
+                          "achieve this by using 'sudo' to run your script")
+            raise
+        return GPIO
+    if backend == BACKEND_SIMULATED:
+        return ScriptedGpio()
+    raise ValueError("Unknown gpio backend '" + str(backend) + "'.")
@@ -0,0 +1,128 @@
+import logging
+import time
+from threading import Thread, Condition
+
+from core.gpio_backend import create_gpio_backend, BACKEND_HARDWARE
+
+DEFAULT_DEBOUNCE = 0.05
+DEFAULT_HOLD_TIME = 0.0
+DEFAULT_POLL_INTERVAL = 1.0
+
+
+class WatchedPin:
+    def __init__(self, pin: int, callback, debounce: float, hold_time: float):
+        self.pin = pin
+        self.callback = callback
+        self.debounce = debounce
+        self.hold_time = hold_time
+        self.polling = False
+        self.reported_state = None
+        self.next_check = None
+        self.off_deadline = None
+
+
+class GpioMonitor:
+    """Serves all watched gpio inputs from one shared event thread. Pins are edge triggered via
+    GPIO.add_event_detect; an edge schedules a debounced re-read of the pin. A falling level is only reported after
+    the hold time has passed without new activity. Pins for which edge detection is not available are polled by
+    the same thread instead."""
+
+    def __init__(self, poll_interval: float = DEFAULT_POLL_INTERVAL, gpio=None):
+        self.__gpio = gpio if gpio is not None else create_gpio_backend(BACKEND_HARDWARE)
+        self.__poll_interval = poll_interval
+        self.__watched_pins = {}
+        self.__condition = Condition()
+
+        self.__gpio.setmode(self.__gpio.BCM)
+
+        self.__event_thread = Thread(target=self.__event_worker, daemon=True)
+        self.__event_thread.start()
+
+        logging.debug("GpioMonitor created")
+
+    def watch(self, pin: int, callback, debounce: float = DEFAULT_DEBOUNCE, hold_time: float = DEFAULT_HOLD_TIME):
+        """Watch the given input pin and call callback(state) whenever its debounced state changes."""
+        watched_pin = WatchedPin(pin, callback, debounce, hold_time)
+        self.__gpio.setup(pin, self.__gpio.IN)
+        try:
+            self.__gpio.add_event_detect(pin, self.__gpio.BOTH, callback=self.__on_edge)
+        except RuntimeError:
+            logging.warning("Edge detection not available for gpio %d, falling back to polling", pin)
+            watched_pin.polling = True
+
+        with self.__condition:
+            watched_pin.next_check = time.monotonic()
+            self.__watched_pins[pin] = watched_pin
+            self.__condition.notify()
+
+    def unwatch(self, pin: int):
+        with self.__condition:
+            watched_pin = self.__watched_pins.pop(pin, None)
+        if watched_pin is not None and not watched_pin.polling:
+            self.__gpio.remove_event_detect(pin)
+
+    def __on_edge(self, pin: int):
+        with self.__condition:
+            watched_pin = self.__watched_pins.get(pin)
+            if watched_pin is not None:
+                watched_pin.next_check = time.monotonic() + watched_pin.debounce
+                self.__condition.notify()
+
+    def __event_worker(self):
+        next_poll = time.monotonic()
+        while True:
+            with self.__condition:
+                now = time.monotonic()
+                poll_due = now >= next_poll
+                if poll_due:
+                    next_poll = now + self.__poll_interval
+
+                due_pins = []
+                for watched_pin in self.__watched_pins.values():
+                    if (watched_pin.next_check is not None and watched_pin.next_check <= now) or \
+                            (poll_due and watched_pin.polling):
+                        watched_pin.next_check = None
+                        due_pins.append(watched_pin)
+
+            for watched_pin in due_pins:
+                state = self.__evaluate(watched_pin, now)
+                if state is None:
+                    continue
+                try:
+                    watched_pin.callback(state)
+                except Exception:
+                    logging.exception("Failed to handle state change of gpio %d", watched_pin.pin)
+
+            with self.__condition:
+                wakeup = next_poll if any(p.polling for p in self.__watched_pins.values()) else None
+                for watched_pin in self.__watched_pins.values():
+                    if watched_pin.next_check is not None and (wakeup is None or watched_pin.next_check < wakeup):
+                        wakeup = watched_pin.next_check
+                timeout = None if wakeup is None else max(0.0, wakeup - time.monotonic())
+                if timeout is None or timeout > 0:
+                    self.__condition.wait(timeout)
+
+    def __evaluate(self, watched_pin: WatchedPin, now: float):
+        """Read the pin and return its new reported state, or None if the reported state did not change."""
+        level = bool(self.__gpio.input(watched_pin.pin))
+
+        with self.__condition:
+            if level:
+                watched_pin.off_deadline = None
+                new_state = True
+            elif watched_pin.reported_state and watched_pin.hold_time > 0:
+                if watched_pin.off_deadline is None:
+                    watched_pin.off_deadline = now + watched_pin.hold_time
+                if now < watched_pin.off_deadline:
+                    if watched_pin.next_check is None or watched_pin.next_check > watched_pin.off_deadline:
+                        watched_pin.next_check = watched_pin.off_deadline
+                    return None
+                watched_pin.off_deadline = None
+                new_state = False
+            else:
+                new_state = False
+
+            if new_state == watched_pin.reported_state:
+                return None
+            watched_pin.reported_state = new_state
+            return new_state
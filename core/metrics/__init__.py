@@ -0,0 +1,214 @@
+import bisect
+import collections
+import logging
+import sys
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock
+
+DEFAULT_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+DEFAULT_PROFILER_INTERVAL = 0.01
+PROFILE_STACK_LIMIT = 50
+
+_command_context = threading.local()
+
+
+def set_command_received_time(received_time: float):
+    """Remember the monotonic time at which the command currently handled by this thread was received."""
+    _command_context.received_time = received_time
+
+
+def get_command_received_time():
+    return getattr(_command_context, "received_time", None)
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.__value = 0
+        self.__lock = Lock()
+
+    def inc(self, amount: float = 1):
+        with self.__lock:
+            self.__value += amount
+
+    def render(self):
+        return ["# HELP {} {}".format(self.name, self.help_text), "# TYPE {} counter".format(self.name),
+                "{} {}".format(self.name, self.__value)]
+
+
+class Gauge:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.__value = 0
+        self.__function = None
+
+    def set(self, value: float):
+        self.__value = value
+
+    def set_function(self, function):
+        """Compute the value on each scrape instead of tracking it on the hot path."""
+        self.__function = function
+
+    def render(self):
+        value = self.__function() if self.__function is not None else self.__value
+        return ["# HELP {} {}".format(self.name, self.help_text), "# TYPE {} gauge".format(self.name),
+                "{} {}".format(self.name, value)]
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: () = DEFAULT_LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.__buckets = tuple(sorted(buckets))
+        self.__bucket_counts = [0] * (len(self.__buckets) + 1)
+        self.__sum = 0.0
+        self.__count = 0
+        self.__lock = Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.__buckets, value)
+        with self.__lock:
+            self.__bucket_counts[index] += 1
+            self.__sum += value
+            self.__count += 1
+
+    def get_count(self):
+        with self.__lock:
+            return self.__count
+
+    def get_sum(self):
+        with self.__lock:
+            return self.__sum
+
+    def get_percentile(self, fraction: float):
+        """Estimate a percentile as the upper bound of the bucket it falls into; inf if it is above all buckets."""
+        with self.__lock:
+            bucket_counts = list(self.__bucket_counts)
+            count = self.__count
+        if count == 0:
+            return float("nan")
+        cumulative_count = 0
+        for bucket, bucket_count in zip(self.__buckets + (float("inf"),), bucket_counts):
+            cumulative_count += bucket_count
+            if cumulative_count >= fraction * count:
+                return bucket
+        return float("inf")
+
+    def render(self):
+        with self.__lock:
+            bucket_counts = list(self.__bucket_counts)
+            histogram_sum = self.__sum
+            count = self.__count
+
+        lines = ["# HELP {} {}".format(self.name, self.help_text), "# TYPE {} histogram".format(self.name)]
+        cumulative_count = 0
+        for bucket, bucket_count in zip(self.__buckets + ("+Inf",), bucket_counts):
+            cumulative_count += bucket_count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, bucket, cumulative_count))
+        lines.append("{}_sum {}".format(self.name, histogram_sum))
+        lines.append("{}_count {}".format(self.name, count))
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.__metrics = collections.OrderedDict()
+        self.__lock = Lock()
+
+    def counter(self, name: str, help_text: str):
+        return self.__get_or_create(name, lambda: Counter(name, help_text))
+
+    def gauge(self, name: str, help_text: str):
+        return self.__get_or_create(name, lambda: Gauge(name, help_text))
+
+    def histogram(self, name: str, help_text: str, buckets: () = DEFAULT_LATENCY_BUCKETS):
+        return self.__get_or_create(name, lambda: Histogram(name, help_text, buckets))
+
+    def render(self):
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+    def __get_or_create(self, name: str, factory):
+        with self.__lock:
+            if name not in self.__metrics:
+                self.__metrics[name] = factory()
+            return self.__metrics[name]
+
+
+REGISTRY = MetricsRegistry()
+
+
+class SamplingProfiler:
+    """Periodically samples the stacks of all threads and counts how often each stack was seen."""
+
+    def __init__(self, interval: float = DEFAULT_PROFILER_INTERVAL):
+        self.__interval = interval
+        self.__stack_counts = collections.Counter()
+        self.__sample_count = 0
+        self.__lock = Lock()
+
+        self.__sampling_thread = Thread(target=self.__sampling_worker, daemon=True)
+        self.__sampling_thread.start()
+
+    def render(self):
+        """Return the sampled stacks in collapsed format ('frame;frame;frame count'), most frequent first."""
+        with self.__lock:
+            lines = ["# {} samples".format(self.__sample_count)]
+            for stack, count in self.__stack_counts.most_common(PROFILE_STACK_LIMIT):
+                lines.append("{} {}".format(stack, count))
+        return "\n".join(lines) + "\n"
+
+    def __sampling_worker(self):
+        own_thread_id = threading.get_ident()
+        while True:
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
+                stacks.append(";".join("{}:{}:{}".format(entry.filename.rsplit("/", 1)[-1], entry.name, entry.lineno)
+                                       for entry in traceback.extract_stack(frame)))
+            with self.__lock:
+                self.__stack_counts.update(stacks)
+                self.__sample_count += 1
+            time.sleep(self.__interval)
+
+
+class MetricsServer:
+    """Local http endpoint serving the metrics in Prometheus text format at /metrics and, if a profiler is given,
+    the sampled stacks at /profile."""
+
+    def __init__(self, host: str, port: int, registry: MetricsRegistry = REGISTRY, profiler: SamplingProfiler = None):
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    self.__respond(registry.render(), "text/plain; version=0.0.4")
+                elif self.path == "/profile" and profiler is not None:
+                    self.__respond(profiler.render(), "text/plain")
+                else:
+                    self.send_error(404)
+
+            def log_message(self, format, *args):
+                logging.debug("Metrics request: " + format, *args)
+
+            def __respond(self, body: str, content_type: str):
+                data = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.__server = ThreadingHTTPServer((host, port), RequestHandler)
+        self.__server.daemon_threads = True
+        self.__server_thread = Thread(target=self.__server.serve_forever, daemon=True)
+        self.__server_thread.start()
+        logging.info("Serving metrics at http://%s:%d/metrics", host, port)
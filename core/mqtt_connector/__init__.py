@@ -1,14 +1,74 @@
 import paho.mqtt.client as mqtt
 import collections
 import logging
+import time
+from threading import Lock, Thread, Condition
+
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+from core.command_dispatcher import CommandDispatcher
+from core.metrics import REGISTRY, set_command_received_time
+from core.outbox import Outbox, OutboxEntry, DEFAULT_OUTBOX_SIZE
+from core.trace_recorder import TraceRecorder
+from core.topic_trie import TopicTrie, TOPIC_SEPARATOR, SINGLE_LEVEL_WILDCARD, MULTI_LEVEL_WILDCARD
+
+MQTT_VERSION_311 = "3.1.1"
+MQTT_VERSION_5 = "5"
+MQTT_PROTOCOLS = {
+    MQTT_VERSION_311: mqtt.MQTTv311,
+    MQTT_VERSION_5: mqtt.MQTTv5,
+}
+DEFAULT_SESSION_EXPIRY = 3600
+DEFAULT_PUBLISH_WINDOW = 0.02
+PUBLISH_RETRY_INTERVAL = 1.0
+
+messages_received = REGISTRY.counter("mqtt_messages_received_total", "Number of mqtt messages received")
+messages_published = REGISTRY.counter("mqtt_messages_published_total", "Number of mqtt messages published")
+messages_unrouted = REGISTRY.counter("mqtt_messages_unrouted_total",
+                                     "Number of mqtt messages received via a wildcard subscription without a handler")
+messages_rejected = REGISTRY.counter("mqtt_messages_rejected_total",
+                                     "Number of mqtt messages dropped because the client rejected the topic or payload")
+
+
+def get_subscription_filter(topic: str) -> str:
+    """Derive the filter a topic is subscribed with. Device topics follow the pattern '<base>/<id>/<suffix>', so the
+    id level is replaced by a wildcard and all devices of a base topic share one subscription per suffix."""
+    levels = topic.split(TOPIC_SEPARATOR)
+    if len(levels) < 3 or SINGLE_LEVEL_WILDCARD in levels or MULTI_LEVEL_WILDCARD in levels:
+        return topic
+    levels[-2] = SINGLE_LEVEL_WILDCARD
+    return TOPIC_SEPARATOR.join(levels)
 
 
 class MqttConnector:
 
-    def __init__(self, server, port, transport):
+    def __init__(self, server, port, transport, dispatcher: CommandDispatcher = None,
+                 mqtt_version: str = MQTT_VERSION_311, session_expiry: int = DEFAULT_SESSION_EXPIRY,
+                 outbox_size: int = DEFAULT_OUTBOX_SIZE, publish_window: float = DEFAULT_PUBLISH_WINDOW,
+                 trace_recorder: TraceRecorder = None, client_factory=mqtt.Client):
+        """The client factory is called like paho's mqtt.Client, it allows replacing the network client, e.g. by an
+        in-process broker stand-in."""
+        if mqtt_version not in MQTT_PROTOCOLS:
+            raise ValueError("Unsupported mqtt version '" + str(mqtt_version) + "', must be one of " +
+                             ", ".join(MQTT_PROTOCOLS) + ".")
+
         self.__is_connected = False
-        self.__topic_handlers = collections.defaultdict(set)
-        self.__client = mqtt.Client(transport=transport)
+        self.__dispatcher = dispatcher
+        self.__topic_trie = TopicTrie()
+        self.__subscription_topics = collections.defaultdict(set)
+        self.__subscribed_filters = set()
+        self.__pending_unsubscribe_filters = set()
+        self.__is_v5 = mqtt_version == MQTT_VERSION_5
+        self.__session_expiry = session_expiry
+        self.__publish_lock = Lock()
+        self.__topic_aliases = {}
+        self.__topic_alias_maximum = 0
+        self.__outbox = Outbox(outbox_size)
+        self.__outbox_condition = Condition()
+        self.__publish_window = publish_window
+        self.__trace_recorder = trace_recorder
+        self.__client = client_factory(transport=transport, protocol=MQTT_PROTOCOLS[mqtt_version])
         self.__client.on_connect = self.__on_connect
         self.__client.on_disconnect = self.__on_disconnect
         self.__client.on_message = self.__on_message
@@ -17,35 +77,179 @@ class MqttConnector:
         self.__server = server
         self.__port = port
         self.__transport = transport
-        self.__client.connect(server, port)
+
+        REGISTRY.gauge("mqtt_outbox_depth", "Number of messages waiting to be published").set_function(
+            self.__outbox.get_size)
+
+        self.__publish_thread = Thread(target=self.__publish_worker, daemon=True)
+        self.__publish_thread.start()
+
+    def connect(self):
+        """Start connecting to the broker in the background. Topics registered until the connection is established
+        are subscribed in one batch. With mqtt v5 the session outlives disconnects for the configured session expiry,
+        so the subscriptions are kept by the broker. The first connection starts a clean session, so subscriptions of
+        a previous run are not kept."""
+        if self.__is_v5:
+            properties = Properties(PacketTypes.CONNECT)
+            properties.SessionExpiryInterval = self.__session_expiry
+            self.__client.connect_async(self.__server, self.__port, clean_start=mqtt.MQTT_CLEAN_START_FIRST_ONLY,
+                                        properties=properties)
+        else:
+            self.__client.connect_async(self.__server, self.__port)
         self.__client.loop_start()
 
-    def subscribe_to_topic(self, topic, callback):
-        self.__topic_handlers[topic].add(callback)
-        if self.__is_connected:
-            self.__client.subscribe(topic)
+    def subscribe_to_topic(self, topic, callback, merge_function=None):
+        """Register a callback for a topic. The broker subscription is shared with all topics mapping to the same
+        wildcard filter, so only the first topic of a filter causes a subscribe. A merge function combines coalesced
+        commands of the topic, see CommandDispatcher.set_merge_function."""
+        self.__topic_trie.add(topic, callback)
+        if merge_function is not None and self.__dispatcher is not None:
+            self.__dispatcher.set_merge_function(topic, merge_function)
+        subscription_filter = get_subscription_filter(topic)
+        is_new_subscription = subscription_filter not in self.__subscription_topics
+        self.__subscription_topics[subscription_filter].add(topic)
+        self.__pending_unsubscribe_filters.discard(subscription_filter)
+        if is_new_subscription and self.__is_connected:
+            self.__client.subscribe(subscription_filter)
+            self.__subscribed_filters.add(subscription_filter)
+
+    def unsubscribe_from_topic(self, topic, callback):
+        """Remove a callback registered via subscribe_to_topic. The broker subscription is only dropped once no topic
+        of its wildcard filter is left. If that fails while disconnected, the unsubscribe is sent after the reconnect
+        in case the broker kept the session."""
+        if not self.__topic_trie.remove(topic, callback):
+            return
+        if self.__dispatcher is not None:
+            self.__dispatcher.set_merge_function(topic, None)
+        subscription_filter = get_subscription_filter(topic)
+        topics = self.__subscription_topics.get(subscription_filter)
+        if topics is None:
+            return
+        topics.discard(topic)
+        if not topics:
+            del self.__subscription_topics[subscription_filter]
+            if subscription_filter in self.__subscribed_filters:
+                self.__subscribed_filters.discard(subscription_filter)
+                rc, _ = self.__client.unsubscribe(subscription_filter)
+                if rc != mqtt.MQTT_ERR_SUCCESS:
+                    self.__pending_unsubscribe_filters.add(subscription_filter)
 
     def publish(self, topic, payload=None, qos=0, retain=False):
-        return self.__client.publish(topic, payload, qos, retain)
+        """Queue a message in the outbox. Messages are published in batches after the publish window, which collapses
+        repeated messages to a topic, and are kept while the broker is not connected."""
+        self.__outbox.put(topic, payload, qos, retain)
+        with self.__outbox_condition:
+            self.__outbox_condition.notify()
+
+    def __publish_worker(self):
+        while True:
+            with self.__outbox_condition:
+                while not self.__is_connected or self.__outbox.get_size() == 0:
+                    self.__outbox_condition.wait()
+            if self.__publish_window > 0:
+                time.sleep(self.__publish_window)
+
+            entries = self.__outbox.take()
+            for index, entry in enumerate(entries):
+                try:
+                    result = self.__publish_entry(entry)
+                except Exception as error:
+                    # e.g. a topic with wildcards or an unsupported payload type, retrying would fail again
+                    logging.error("Dropping message to topic '%s' which cannot be published: %s", entry.topic, error)
+                    messages_rejected.inc()
+                    continue
+                if result.rc != mqtt.MQTT_ERR_SUCCESS:
+                    logging.warning("Publishing failed, keeping %d messages for the next connection",
+                                    len(entries) - index)
+                    self.__outbox.requeue(entries[index:])
+                    time.sleep(PUBLISH_RETRY_INTERVAL)
+                    break
+                messages_published.inc()
+
+    def __publish_entry(self, entry: OutboxEntry):
+        """Publish an outbox entry. With mqtt v5 every topic gets a topic alias while the broker grants some, so
+        repeated publishes to the same topic only carry the two byte alias instead of the topic name."""
+        if not self.__is_v5:
+            return self.__client.publish(entry.topic, entry.payload, entry.qos, entry.retain)
+
+        with self.__publish_lock:
+            topic = entry.topic
+            properties = None
+            new_topic_alias = None
+            topic_alias = self.__topic_aliases.get(topic)
+            if topic_alias is None and len(self.__topic_aliases) < self.__topic_alias_maximum:
+                new_topic_alias = len(self.__topic_aliases) + 1
+                properties = Properties(PacketTypes.PUBLISH)
+                properties.TopicAlias = new_topic_alias
+            elif topic_alias is not None:
+                properties = Properties(PacketTypes.PUBLISH)
+                properties.TopicAlias = topic_alias
+                topic = ""
+            result = self.__client.publish(topic, entry.payload, entry.qos, entry.retain, properties)
+            # the alias is only known to the broker once a publish carrying it went through
+            if new_topic_alias is not None:
+                self.__topic_aliases[topic] = new_topic_alias
+            return result
 
-    def __on_connect(self, client, userdata, flags, rc):
+    def __on_connect(self, client, userdata, flags, rc, properties=None):
         self.__is_connected = True
-        logging.info("Connected to mqtt broker at %s:%d with result code %d", self.__server, self.__port, rc)
+        logging.info("Connected to mqtt broker at %s:%d with result code %s", self.__server, self.__port, rc)
+
+        with self.__publish_lock:
+            # topic aliases are only valid within a single network connection
+            self.__topic_aliases = {}
+            self.__topic_alias_maximum = getattr(properties, "TopicAliasMaximum", 0) if properties else 0
+
+        if self.__is_v5 and flags.get("session present"):
+            self.__send_pending_unsubscribes()
+        else:
+            self.__subscribed_filters = set()
+            self.__pending_unsubscribe_filters = set()
         self.__resubscribe_to_topics()
 
+        # flush the messages kept in the outbox while disconnected
+        with self.__outbox_condition:
+            self.__outbox_condition.notify()
+
+    def __send_pending_unsubscribes(self):
+        """Drop the subscriptions the broker kept in the session although they were unsubscribed while
+        disconnected."""
+        subscription_filters = [subscription_filter for subscription_filter in self.__pending_unsubscribe_filters.copy()
+                                if subscription_filter not in self.__subscription_topics]
+        self.__pending_unsubscribe_filters = set()
+        if subscription_filters:
+            logging.debug("Unsubscribing from topics %s", subscription_filters)
+            self.__client.unsubscribe(subscription_filters)
+
     def __resubscribe_to_topics(self):
-        for topic in self.__topic_handlers.copy():
-            logging.debug("Resubscribing to topic '%s'", topic)
-            self.__client.subscribe(topic)
+        subscription_filters = [subscription_filter for subscription_filter in self.__subscription_topics.copy()
+                                if subscription_filter not in self.__subscribed_filters]
+        if subscription_filters:
+            logging.debug("Resubscribing to topics %s", subscription_filters)
+            self.__client.subscribe([(subscription_filter, 0) for subscription_filter in subscription_filters])
+            self.__subscribed_filters.update(subscription_filters)
 
-    def __on_disconnect(self, client, userdata, rc):
+    def __on_disconnect(self, client, userdata, rc, properties=None):
         self.__is_connected = False
-        logging.warning("Disconnected with result code %d", rc)
+        logging.warning("Disconnected with result code %s", rc)
 
     def __on_message(self, client, userdata, msg):
-        self.__trigger_handler_callbacks(msg.topic, msg.payload)
+        messages_received.inc()
+        received_time = time.monotonic()
+        if self.__trace_recorder is not None:
+            self.__trace_recorder.record(msg.topic, msg.payload, received_time)
+        self.__trigger_handler_callbacks(msg.topic, msg.payload, received_time)
+
+    def __trigger_handler_callbacks(self, topic, payload, received_time):
+        handlers = self.__topic_trie.match(topic)
+        if not handlers:
+            messages_unrouted.inc()
+            return
 
-    def __trigger_handler_callbacks(self, topic, payload):
-        if topic in self.__topic_handlers:
-            for handler in self.__topic_handlers.get(topic, []):
+        if self.__dispatcher is not None:
+            self.__dispatcher.dispatch(topic, payload, handlers, received_time)
+        else:
+            set_command_received_time(received_time)
+            for handler in handlers:
                 handler(payload)
+            set_command_received_time(None)
@@ -0,0 +1,94 @@
+import collections
+from threading import Lock
+
+from core.metrics import REGISTRY
+
+DEFAULT_OUTBOX_SIZE = 1000
+
+messages_coalesced = REGISTRY.counter("mqtt_outbox_coalesced_total",
+                                      "Number of messages replaced by a newer one before publishing")
+messages_dropped = REGISTRY.counter("mqtt_outbox_dropped_total",
+                                    "Number of messages dropped because the outbox was full")
+
+
+class OutboxEntry:
+    __slots__ = ("topic", "payload", "qos", "retain")
+
+    def __init__(self, topic: str, payload, qos: int, retain: bool):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+
+class Outbox:
+    """Bounded queue of pending publishes. Retained messages describe a state, so a newer one replaces the pending
+    message of its topic in place. Other messages are events and queued in order, only a repetition of the pending
+    payload of a topic is collapsed. If the outbox is full, the oldest message is dropped."""
+
+    def __init__(self, max_size: int = DEFAULT_OUTBOX_SIZE):
+        self.__max_size = max_size
+        self.__entries = collections.deque()
+        self.__state_entries = {}
+        self.__last_event_entries = {}
+        self.__coalesced_count = 0
+        self.__dropped_count = 0
+        self.__lock = Lock()
+
+    def put(self, topic: str, payload, qos: int = 0, retain: bool = False):
+        with self.__lock:
+            pending_entry = self.__state_entries.get(topic) if retain else self.__last_event_entries.get(topic)
+            if pending_entry is not None and (retain or pending_entry.payload == payload):
+                pending_entry.payload = payload
+                pending_entry.qos = max(pending_entry.qos, qos)
+                self.__coalesced_count += 1
+                messages_coalesced.inc()
+                return
+            self.__append(OutboxEntry(topic, payload, qos, retain))
+
+    def requeue(self, entries: ()):
+        """Put entries which could not be published back in front of the outbox, unless a newer state of their topic
+        is already pending."""
+        with self.__lock:
+            for entry in reversed(entries):
+                if entry.retain and entry.topic in self.__state_entries:
+                    continue
+                self.__entries.appendleft(entry)
+                if entry.retain:
+                    self.__state_entries[entry.topic] = entry
+            while len(self.__entries) > self.__max_size:
+                self.__forget(self.__entries.popleft())
+
+    def take(self) -> ():
+        """Remove and return all pending entries in publish order."""
+        with self.__lock:
+            entries = tuple(self.__entries)
+            self.__entries.clear()
+            self.__state_entries.clear()
+            self.__last_event_entries.clear()
+            return entries
+
+    def get_size(self):
+        with self.__lock:
+            return len(self.__entries)
+
+    def get_statistics(self):
+        with self.__lock:
+            return {"coalesced": self.__coalesced_count, "dropped": self.__dropped_count}
+
+    def __append(self, entry: OutboxEntry):
+        self.__entries.append(entry)
+        if entry.retain:
+            self.__state_entries[entry.topic] = entry
+        else:
+            self.__last_event_entries[entry.topic] = entry
+        if len(self.__entries) > self.__max_size:
+            self.__forget(self.__entries.popleft())
+
+    def __forget(self, entry: OutboxEntry):
+        self.__dropped_count += 1
+        messages_dropped.inc()
+        if self.__state_entries.get(entry.topic) is entry:
+            del self.__state_entries[entry.topic]
+        if self.__last_event_entries.get(entry.topic) is entry:
+            del self.__last_event_entries[entry.topic]
@@ -1,23 +1,291 @@
 import logging
-from threading import Lock
+import time
+from threading import Thread, Condition, Lock
 
-import Adafruit_PCA9685
+from core.pwm_backend import create_pwm_backend, BACKEND_HARDWARE, LED0_ON_L, REGISTERS_PER_CHANNEL
+from core.metrics import REGISTRY, get_command_received_time
 
+MODE1 = 0x00
+MODE1_AUTO_INCREMENT = 0x20
+# SMBus block transfers are limited to 32 bytes, which covers the registers of 8 channels
+BLOCK_WRITE_MAX_CHANNELS = 8
 
-class PiPwm:
-    __pwm = Adafruit_PCA9685.PCA9685()
-    __pwm.set_pwm_freq(1000)
+CHANNELS_PER_BOARD = 16
+DEFAULT_BOARD_NAME = "default"
+DEFAULT_BOARD_ADDRESS = 0x40
+DEFAULT_PWM_FREQUENCY = 1000
+# delay before the channels of a failing board are written again, doubled with every further failure
+WRITE_RETRY_DELAY = 1.0
+MAX_WRITE_RETRY_DELAY = 60.0
+
+command_to_output_latency = REGISTRY.histogram("command_to_output_latency_seconds",
+                                               "Time from receiving a command to writing the resulting pwm registers")
+i2c_write_duration = REGISTRY.histogram("i2c_write_duration_seconds",
+                                        "Duration of flushing the dirty channels of a board")
+i2c_write_errors = REGISTRY.counter("i2c_write_errors_total", "Number of failed board writes")
+pwm_lock_wait = REGISTRY.histogram("pwm_lock_wait_seconds", "Time spent waiting for the lock of a bus writer")
+
+
+def parse_channel_id(channel_spec, board_names: list) -> int:
+    """Translate a channel specification, either a plain channel id or 'board:channel', to a global channel id
+    (board index * 16 + channel). Boards are referenced by name or index."""
+    channel_spec = str(channel_spec).strip()
+    if ":" not in channel_spec:
+        channel_id = int(channel_spec)
+        if channel_id < 0 or channel_id >= len(board_names) * CHANNELS_PER_BOARD:
+            raise IndexError("Channel must be in range between 0 and " +
+                             str(len(board_names) * CHANNELS_PER_BOARD - 1) + ".")
+        return channel_id
+
+    board_name, channel = channel_spec.split(":", 1)
+    board_name = board_name.strip()
+    if board_name in board_names:
+        board_index = board_names.index(board_name)
+    elif board_name.isnumeric() and int(board_name) < len(board_names):
+        board_index = int(board_name)
+    else:
+        raise KeyError("Unknown pwm board '" + board_name + "'.")
+
+    channel = int(channel)
+    if channel < 0 or channel >= CHANNELS_PER_BOARD:
+        raise IndexError("Channel must be in range between 0 and " + str(CHANNELS_PER_BOARD - 1) + ".")
+    return board_index * CHANNELS_PER_BOARD + channel
+
+
+class BoardConfig:
+    def __init__(self, name: str, address: int = DEFAULT_BOARD_ADDRESS, busnum: int = None,
+                 frequency: int = DEFAULT_PWM_FREQUENCY, backend: str = BACKEND_HARDWARE):
+        self.name = name
+        self.address = address
+        self.busnum = busnum
+        self.frequency = frequency
+        self.backend = backend
+
+
+class Pca9685Board:
+    """A single PCA9685 board, keeping a shadow copy of its channel registers. Changed channels are marked dirty
+    and flushed with auto-increment block writes over consecutive LEDn registers. The device is opened on the
+    first write."""
+
+    def __init__(self, config: BoardConfig):
+        self.__config = config
+        self.__pwm = None
+        self.__open_lock = Lock()
+
+        # the PCA9685 driver resets all channels to 0 on initialization
+        self.__shadow_registers = [0] * CHANNELS_PER_BOARD
+        self.__dirty_channels = set()
+
+    def get_name(self):
+        return self.__config.name
+
+    def get_backend(self):
+        """Return the backend of the board, opening the device on first use."""
+        with self.__open_lock:
+            if self.__pwm is None:
+                pwm = create_pwm_backend(self.__config.backend, self.__config.address, self.__config.busnum)
+                pwm.set_pwm_freq(self.__config.frequency)
+                pwm.write8(MODE1, pwm.read_u8(MODE1) | MODE1_AUTO_INCREMENT)
+                self.__pwm = pwm
+                logging.debug("PCA9685 board '%s' initialized at address 0x%02x", self.__config.name,
+                              self.__config.address)
+            return self.__pwm
+
+    def get_channel_value(self, channel: int):
+        return self.__shadow_registers[channel]
+
+    def update_channel_value(self, channel: int, value: int):
+        if self.__shadow_registers[channel] != value:
+            self.__shadow_registers[channel] = value
+            self.__dirty_channels.add(channel)
+
+    def take_dirty_channels(self):
+        """Return the dirty channels with their values and reset the dirty state."""
+        dirty_channels = {channel: self.__shadow_registers[channel] for channel in sorted(self.__dirty_channels)}
+        self.__dirty_channels.clear()
+        return dirty_channels
+
+    def mark_dirty(self, channels):
+        """Mark channels dirty again, e.g. after a failed write, so their shadow values are written with the next
+        flush."""
+        self.__dirty_channels.update(channels)
+
+    def write_channels(self, channel_values: dict):
+        channels = list(channel_values.keys())
+        i = 0
+        while i < len(channels):
+            first_channel = channels[i]
+            last_channel = first_channel
+            while i < len(channels) and channels[i] < first_channel + BLOCK_WRITE_MAX_CHANNELS:
+                last_channel = channels[i]
+                i += 1
+
+            if first_channel == last_channel:
+                self.get_backend().set_pwm(first_channel, 0, channel_values[first_channel])
+            else:
+                self.__write_block(first_channel, last_channel, channel_values)
+
+    def __write_block(self, first_channel: int, last_channel: int, channel_values: dict):
+        data = []
+        for channel in range(first_channel, last_channel + 1):
+            value = channel_values.get(channel, self.__shadow_registers[channel])
+            data += [0, 0, value & 0xFF, value >> 8]
+        self.get_backend().write_list(LED0_ON_L + REGISTERS_PER_CHANNEL * first_channel, data)
+
+
+class CommandReceivedTimes:
+    """Receive times of the commands behind one pwm update. An update can span several buses, so the times are
+    taken by the first bus writer which writes its part of the update and the latency is observed only once."""
+
+    def __init__(self, command_received_times: ()):
+        self.__command_received_times = tuple(command_received_times)
+        self.__lock = Lock()
+
+    def take(self) -> ():
+        with self.__lock:
+            command_received_times = self.__command_received_times
+            self.__command_received_times = ()
+            return command_received_times
+
+
+class BusWriter:
+    """Worker flushing the dirty channels of all boards attached to one I2C bus, so boards on different buses are
+    updated in parallel."""
+
+    def __init__(self, busnum: int):
+        self.__busnum = busnum
+        self.__boards = []
+        self.__condition = Condition()
+        self.__has_pending_writes = False
+        self.__pending_command_received_times = []
+        self.__retry_times = {}
+        self.__retry_delays = {}
 
-    __lock = Lock()
+        self.__worker_thread = Thread(target=self.__write_worker, daemon=True)
+        self.__worker_thread.start()
+
+    def add_board(self, board: Pca9685Board):
+        self.__boards.append(board)
+
+    def submit(self, board_channel_values: (), command_received_times: CommandReceivedTimes = None):
+        """Update the shadow registers for a sequence of (board, channel, value) entries and wake up the worker.
+        The receive times of the commands causing the update are used to track the command to output latency."""
+        lock_requested = time.monotonic()
+        with self.__condition:
+            pwm_lock_wait.observe(time.monotonic() - lock_requested)
+            for board, channel, value in board_channel_values:
+                board.update_channel_value(channel, value)
+            if command_received_times is not None:
+                self.__pending_command_received_times.append(command_received_times)
+            self.__has_pending_writes = True
+            self.__condition.notify()
+
+    def get_channel_value(self, board: Pca9685Board, channel: int):
+        with self.__condition:
+            return board.get_channel_value(channel)
+
+    def __write_worker(self):
+        while True:
+            with self.__condition:
+                while not self.__has_pending_writes and not self.__is_retry_due(time.monotonic()):
+                    self.__condition.wait(self.__get_retry_timeout(time.monotonic()))
+                self.__has_pending_writes = False
+                now = time.monotonic()
+                # failing boards keep their dirty channels until their retry is due
+                pending_writes = [(board, board.take_dirty_channels()) for board in self.__boards
+                                  if self.__retry_times.get(board, now) <= now]
+                command_received_times = self.__pending_command_received_times
+                self.__pending_command_received_times = []
+
+            written = False
+            for board, channel_values in pending_writes:
+                if not channel_values:
+                    self.__retry_times.pop(board, None)
+                    continue
+                write_start = time.monotonic()
+                try:
+                    board.write_channels(channel_values)
+                    written = True
+                    self.__on_write_succeeded(board)
+                except Exception:
+                    # opening the board happens on the first write, so any failure (e.g. a missing driver) is retried
+                    # instead of ending the worker
+                    with self.__condition:
+                        board.mark_dirty(channel_values.keys())
+                    self.__on_write_failed(board)
+                i2c_write_duration.observe(time.monotonic() - write_start)
+
+            if written:
+                now = time.monotonic()
+                for pending_command_received_times in command_received_times:
+                    for command_received_time in pending_command_received_times.take():
+                        command_to_output_latency.observe(now - command_received_time)
+
+    def __on_write_succeeded(self, board: Pca9685Board):
+        if self.__retry_delays.pop(board, None) is not None:
+            self.__retry_times.pop(board, None)
+            logging.info("Writing channels of board '%s' on bus %s succeeded again", board.get_name(), self.__busnum)
+
+    def __on_write_failed(self, board: Pca9685Board):
+        i2c_write_errors.inc()
+        retry_delay = self.__retry_delays.get(board)
+        if retry_delay is None:
+            retry_delay = WRITE_RETRY_DELAY
+            logging.exception("Failed to write channels of board '%s' on bus %s, retrying with backoff",
+                              board.get_name(), self.__busnum)
+        else:
+            retry_delay = min(2 * retry_delay, MAX_WRITE_RETRY_DELAY)
+            logging.debug("Writing channels of board '%s' on bus %s still fails", board.get_name(), self.__busnum)
+        self.__retry_delays[board] = retry_delay
+        self.__retry_times[board] = time.monotonic() + retry_delay
+
+    def __is_retry_due(self, now: float):
+        return any(retry_time <= now for retry_time in self.__retry_times.values())
+
+    def __get_retry_timeout(self, now: float):
+        if not self.__retry_times:
+            return None
+        return max(0.0, min(self.__retry_times.values()) - now)
+
+
+class PiPwm:
+    """Pwm output across one or more PCA9685 boards. Channels are addressed by a global channel id, which is
+    board index * 16 + channel; parse_channel_id translates 'board:channel' specifications."""
 
     CHANNEL_RANGE_START = 0
-    CHANNEL_RANGE_END = 15
 
     CHANNEL_VALUE_MIN = 0
     CHANNEL_VALUE_MAX = 4095
 
-    def __init__(self):
-        logging.debug("PiPwm created")
+    def __init__(self, board_configs: () = None, backend: str = BACKEND_HARDWARE):
+        if not board_configs:
+            board_configs = (BoardConfig(DEFAULT_BOARD_NAME, backend=backend),)
+
+        self.__boards = []
+        self.__bus_writers = {}
+        self.__board_bus_writers = []
+        for board_config in board_configs:
+            board = Pca9685Board(board_config)
+            if board_config.busnum not in self.__bus_writers:
+                self.__bus_writers[board_config.busnum] = BusWriter(board_config.busnum)
+            bus_writer = self.__bus_writers[board_config.busnum]
+            bus_writer.add_board(board)
+
+            self.__boards.append(board)
+            self.__board_bus_writers.append(bus_writer)
+
+        self.CHANNEL_RANGE_END = len(self.__boards) * CHANNELS_PER_BOARD - 1
+        logging.debug("PiPwm created with %d boards on %d buses", len(self.__boards), len(self.__bus_writers))
+
+    def get_boards(self):
+        return tuple(self.__boards)
+
+    def parse_channel_id(self, channel_spec) -> int:
+        """Translate a channel specification, either a plain channel id or 'board:channel', to a global channel id."""
+        return parse_channel_id(channel_spec, [board.get_name() for board in self.__boards])
+
+    def parse_channel_ids(self, channel_specs: str) -> ():
+        return tuple(self.parse_channel_id(channel_spec) for channel_spec in channel_specs.split(","))
 
     def set_pwm_channel_value(self, pwm_channel_id: int, pwm_channel_value: int):
         self.__set_pwm_value(pwm_channel_id, pwm_channel_value)
@@ -31,7 +299,36 @@ class PiPwm:
         else:
             self.__set_pwm_value(pwm_channel_id, 0)
 
+    def set_pwm_channel_values(self, pwm_channel_values: dict, command_received_times: () = None):
+        """Update multiple channels at once. The values are grouped by bus and handed to the bus writers, which only
+        write channels whose value differs from the shadow registers."""
+        if command_received_times is None:
+            command_received_time = get_command_received_time()
+            command_received_times = () if command_received_time is None else (command_received_time,)
+
+        for pwm_channel_id, pwm_channel_value in pwm_channel_values.items():
+            self.__check_range(pwm_channel_id, pwm_channel_value)
+
+        bus_writes = {}
+        for pwm_channel_id, pwm_channel_value in pwm_channel_values.items():
+            board_index, channel = divmod(pwm_channel_id, CHANNELS_PER_BOARD)
+            bus_writer = self.__board_bus_writers[board_index]
+            bus_writes.setdefault(bus_writer, []).append(
+                (self.__boards[board_index], channel, int(pwm_channel_value)))
+
+        shared_command_received_times = CommandReceivedTimes(command_received_times) if command_received_times \
+            else None
+        for bus_writer, board_channel_values in bus_writes.items():
+            bus_writer.submit(board_channel_values, shared_command_received_times)
+
+    def get_pwm_channel_value(self, pwm_channel_id: int):
+        board_index, channel = divmod(pwm_channel_id, CHANNELS_PER_BOARD)
+        return self.__board_bus_writers[board_index].get_channel_value(self.__boards[board_index], channel)
+
     def __set_pwm_value(self, pwm_channel_id: int, pwm_channel_value: int):
+        self.set_pwm_channel_values({pwm_channel_id: pwm_channel_value})
+
+    def __check_range(self, pwm_channel_id: int, pwm_channel_value: int):
         if pwm_channel_id < self.CHANNEL_RANGE_START or pwm_channel_id > self.CHANNEL_RANGE_END:
             raise IndexError("Channel id must be in range between " + str(self.CHANNEL_RANGE_START) + " and " + str(
                 self.CHANNEL_RANGE_END) + ".")
@@ -39,6 +336,3 @@ class PiPwm:
         if pwm_channel_value < self.CHANNEL_VALUE_MIN or pwm_channel_value > self.CHANNEL_VALUE_MAX:
             raise IndexError("Channel value must be in range between " + str(self.CHANNEL_VALUE_MIN) + " and " + str(
                 self.CHANNEL_VALUE_MAX) + ".")
-
-        with self.__lock:
-            self.__pwm.set_pwm(pwm_channel_id, 0, int(pwm_channel_value))
@@ -0,0 +1,108 @@
+import logging
+import time
+from threading import Lock
+
+BACKEND_HARDWARE = "hardware"
+BACKEND_SIMULATED = "simulated"
+
+LED0_ON_L = 0x06
+REGISTERS_PER_CHANNEL = 4
+REGISTER_COUNT = 256
+
+
+class Pca9685Backend:
+    """Real PCA9685 board, accessed via the Adafruit driver."""
+
+    def __init__(self, address: int, busnum: int = None):
+        import Adafruit_PCA9685
+
+        if busnum is None:
+            self.__pwm = Adafruit_PCA9685.PCA9685(address=address)
+        else:
+            self.__pwm = Adafruit_PCA9685.PCA9685(address=address, busnum=busnum)
+
+    def set_pwm_freq(self, frequency: int):
+        self.__pwm.set_pwm_freq(frequency)
+
+    def set_pwm(self, channel: int, on: int, off: int):
+        self.__pwm.set_pwm(channel, on, off)
+
+    def read_u8(self, register: int):
+        return self.__pwm._device.readU8(register)
+
+    def write8(self, register: int, value: int):
+        self.__pwm._device.write8(register, value)
+
+    def write_list(self, register: int, data: list):
+        self.__pwm._device.writeList(register, data)
+
+
+class SimulatedPca9685Backend:
+    """In-memory PCA9685 register file, recording every bus transaction with a timestamp."""
+
+    def __init__(self, address: int, busnum: int = None, write_delay: float = 0.0):
+        self.__address = address
+        self.__busnum = busnum
+        self.__write_delay = write_delay
+        self.__frequency = None
+        self.__registers = [0] * REGISTER_COUNT
+        self.__transactions = []
+        self.__lock = Lock()
+        logging.debug("Simulated PCA9685 created at address 0x%02x", address)
+
+    def set_write_delay(self, write_delay: float):
+        """Simulate the bus time of each transaction."""
+        self.__write_delay = write_delay
+
+    def set_pwm_freq(self, frequency: int):
+        self.__frequency = frequency
+
+    def set_pwm(self, channel: int, on: int, off: int):
+        self.write_list(LED0_ON_L + REGISTERS_PER_CHANNEL * channel, [on & 0xFF, on >> 8, off & 0xFF, off >> 8])
+
+    def read_u8(self, register: int):
+        with self.__lock:
+            return self.__registers[register]
+
+    def write8(self, register: int, value: int):
+        self.write_list(register, [value])
+
+    def write_list(self, register: int, data: list):
+        if self.__write_delay > 0:
+            time.sleep(self.__write_delay)
+        with self.__lock:
+            self.__registers[register:register + len(data)] = data
+            self.__transactions.append((time.monotonic(), register, tuple(data)))
+
+    def get_channel_value(self, channel: int):
+        """Return the off count of the given channel, which is the value written by PiPwm."""
+        register = LED0_ON_L + REGISTERS_PER_CHANNEL * channel
+        with self.__lock:
+            return self.__registers[register + 2] | (self.__registers[register + 3] << 8)
+
+    def get_transactions(self):
+        """Return the recorded (timestamp, register, data) transactions."""
+        with self.__lock:
+            return list(self.__transactions)
+
+    def clear_transactions(self):
+        with self.__lock:
+            self.__transactions = []
+
+
+def create_pwm_backend(backend: str, address: int, busnum: int = None):
+    if backend == BACKEND_HARDWARE:
+        return Pca9685Backend(address, busnum)
+    if backend == BACKEND_SIMULATED:
+        return SimulatedPca9685Backend(address, busnum)
+    raise ValueError("Unknown pwm backend '" + str(backend) + "'.")
+
+
+def get_written_channels(register: int, data: ()):
+    """Return the channels whose LEDn registers are touched by a transaction."""
+    first_register = max(register, LED0_ON_L)
+    last_register = register + len(data) - 1
+    if last_register < LED0_ON_L:
+        return range(0)
+    return range((first_register - LED0_ON_L) // REGISTERS_PER_CHANNEL,
+                 min(15, (last_register - LED0_ON_L) // REGISTERS_PER_CHANNEL) + 1)
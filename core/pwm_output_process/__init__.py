@@ -0,0 +1,140 @@
+import atexit
+import logging
+import multiprocessing
+import os
+import struct
+import time
+from multiprocessing import shared_memory
+from threading import Lock
+
+from core.pi_pwm import PiPwm, BoardConfig, CHANNELS_PER_BOARD, DEFAULT_BOARD_NAME, parse_channel_id
+from core.pwm_backend import BACKEND_HARDWARE
+
+DEFAULT_OUTPUT_FRAME_RATE = 100
+
+# the buffer starts with a sequence counter, which is odd while a frame is being written
+HEADER_FORMAT = "Q"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+CHANNEL_VALUE_FORMAT = "H"
+
+
+class SharedMemoryPwm:
+    """Drop-in replacement for PiPwm, which runs the pwm output in a dedicated process. The handler side only
+    writes the target channel values into a shared memory frame buffer; the output process polls the buffer with a
+    fixed frame rate and writes changed channels to the boards, independent of mqtt traffic and the GIL of this
+    process."""
+
+    CHANNEL_RANGE_START = 0
+
+    CHANNEL_VALUE_MIN = 0
+    CHANNEL_VALUE_MAX = 4095
+
+    def __init__(self, board_configs: () = None, backend: str = BACKEND_HARDWARE,
+                 frame_rate: float = DEFAULT_OUTPUT_FRAME_RATE):
+        if not board_configs:
+            board_configs = (BoardConfig(DEFAULT_BOARD_NAME, backend=backend),)
+        self.__board_names = [board_config.name for board_config in board_configs]
+        self.__channel_count = len(board_configs) * CHANNELS_PER_BOARD
+        self.CHANNEL_RANGE_END = self.__channel_count - 1
+
+        self.__shared_memory = shared_memory.SharedMemory(
+            create=True, size=HEADER_SIZE + self.__channel_count * struct.calcsize(CHANNEL_VALUE_FORMAT))
+        self.__header = self.__shared_memory.buf[:HEADER_SIZE].cast(HEADER_FORMAT)
+        self.__frame = self.__shared_memory.buf[HEADER_SIZE:].cast(CHANNEL_VALUE_FORMAT)
+        self.__lock = Lock()
+        self.__closed = False
+
+        context = multiprocessing.get_context("spawn")
+        self.__process = context.Process(target=run_output_process,
+                                         args=(self.__shared_memory.name, tuple(board_configs), frame_rate,
+                                               os.getpid()),
+                                         name="pwm-output", daemon=True)
+        self.__process.start()
+        atexit.register(self.close)
+
+        logging.debug("SharedMemoryPwm created with output process %d", self.__process.pid)
+
+    def close(self):
+        if self.__closed:
+            return
+        self.__closed = True
+        if self.__process.is_alive():
+            self.__process.terminate()
+            self.__process.join()
+        self.__header.release()
+        self.__frame.release()
+        self.__shared_memory.close()
+        self.__shared_memory.unlink()
+
+    def parse_channel_id(self, channel_spec) -> int:
+        return parse_channel_id(channel_spec, self.__board_names)
+
+    def parse_channel_ids(self, channel_specs: str) -> ():
+        return tuple(self.parse_channel_id(channel_spec) for channel_spec in channel_specs.split(","))
+
+    def set_pwm_channel_value(self, pwm_channel_id: int, pwm_channel_value: int):
+        self.set_pwm_channel_values({pwm_channel_id: pwm_channel_value})
+
+    def set_pwm_channel_percentage_value(self, pwm_channel_id: int, pwm_channel_percentage: float):
+        self.set_pwm_channel_values({pwm_channel_id: int(pwm_channel_percentage * 4095)})
+
+    def set_pwm_channel_bool(self, pwm_channel_id: int, pwm_channel_active: bool):
+        self.set_pwm_channel_values({pwm_channel_id: 4095 if pwm_channel_active is True else 0})
+
+    def set_pwm_channel_values(self, pwm_channel_values: dict, command_received_times: () = None):
+        for pwm_channel_id, pwm_channel_value in pwm_channel_values.items():
+            self.__check_range(pwm_channel_id, pwm_channel_value)
+
+        with self.__lock:
+            self.__header[0] += 1
+            for pwm_channel_id, pwm_channel_value in pwm_channel_values.items():
+                self.__frame[pwm_channel_id] = int(pwm_channel_value)
+            self.__header[0] += 1
+
+    def get_pwm_channel_value(self, pwm_channel_id: int):
+        return self.__frame[pwm_channel_id]
+
+    def __check_range(self, pwm_channel_id: int, pwm_channel_value: int):
+        if pwm_channel_id < self.CHANNEL_RANGE_START or pwm_channel_id > self.CHANNEL_RANGE_END:
+            raise IndexError("Channel id must be in range between " + str(self.CHANNEL_RANGE_START) + " and " + str(
+                self.CHANNEL_RANGE_END) + ".")
+
+        if pwm_channel_value < self.CHANNEL_VALUE_MIN or pwm_channel_value > self.CHANNEL_VALUE_MAX:
+            raise IndexError("Channel value must be in range between " + str(self.CHANNEL_VALUE_MIN) + " and " + str(
+                self.CHANNEL_VALUE_MAX) + ".")
+
+
+def run_output_process(shared_memory_name: str, board_configs: (), frame_rate: float, parent_pid: int):
+    """Entry point of the output process: copy consistent frames from the shared memory buffer to the boards."""
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s pwm-output: %(message)s', level=logging.INFO,
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    buffer = shared_memory.SharedMemory(name=shared_memory_name)
+    header = buffer.buf[:HEADER_SIZE].cast(HEADER_FORMAT)
+    frame = buffer.buf[HEADER_SIZE:].cast(CHANNEL_VALUE_FORMAT)
+    pwm = PiPwm(board_configs)
+
+    frame_interval = 1.0 / frame_rate
+    last_sequence = 0
+    last_frame = [0] * len(frame)
+    next_frame_time = time.monotonic()
+    while os.getppid() == parent_pid:
+        sequence = header[0]
+        if sequence != last_sequence and sequence % 2 == 0:
+            current_frame = frame.tolist()
+            # discard frames which were modified while being copied
+            if header[0] == sequence:
+                last_sequence = sequence
+                changed = {channel_id: value for channel_id, (value, last_value)
+                           in enumerate(zip(current_frame, last_frame)) if value != last_value}
+                last_frame = current_frame
+                if changed:
+                    pwm.set_pwm_channel_values(changed, ())
+
+        next_frame_time += frame_interval
+        delay = next_frame_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_frame_time = time.monotonic()
+
+    logging.warning("Parent process %d exited, stopping pwm output", parent_pid)
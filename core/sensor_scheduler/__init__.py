@@ -0,0 +1,113 @@
+import heapq
+import itertools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Condition
+
+from core.metrics import REGISTRY
+
+DEFAULT_READ_WORKERS = 2
+DEFAULT_RETRY_INTERVAL = 2.5
+
+sensor_reads = REGISTRY.counter("sensor_reads_total", "Number of sensor reads")
+sensor_read_errors = REGISTRY.counter("sensor_read_errors_total", "Number of failed sensor reads")
+sensor_read_duration = REGISTRY.histogram("sensor_read_duration_seconds", "Duration of sensor reads",
+                                          buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+
+
+class ScheduledSensor:
+    def __init__(self, key, read_function, interval: float, callback, retry_interval: float):
+        self.key = key
+        self.read_function = read_function
+        self.interval = interval
+        self.callback = callback
+        self.retry_interval = retry_interval
+        self.last_reading = None
+        self.last_reading_time = None
+        self.removed = False
+
+
+class SensorScheduler:
+    """Samples all sensors from one scheduler thread. Each sensor is read in its own interval; the reads run on a
+    small worker pool, so a slow sensor does not delay the others. A failed read (read function returns None or
+    raises) is retried after the retry interval, while the last good reading stays available."""
+
+    def __init__(self, read_workers: int = DEFAULT_READ_WORKERS):
+        self.__sensors = {}
+        self.__schedule = []
+        self.__sequence = itertools.count()
+        self.__condition = Condition()
+        self.__executor = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix="sensor-read")
+
+        self.__scheduler_thread = Thread(target=self.__schedule_loop, daemon=True)
+        self.__scheduler_thread.start()
+
+        logging.debug("SensorScheduler created")
+
+    def add(self, key, read_function, interval: float, callback, retry_interval: float = DEFAULT_RETRY_INTERVAL):
+        """Sample read_function every interval seconds, starting immediately, and call callback(reading) with every
+        good reading."""
+        with self.__condition:
+            self.remove(key)
+            sensor = ScheduledSensor(key, read_function, interval, callback, retry_interval)
+            self.__sensors[key] = sensor
+            self.__push(time.monotonic(), sensor)
+
+    def remove(self, key):
+        with self.__condition:
+            sensor = self.__sensors.pop(key, None)
+            if sensor is not None:
+                sensor.removed = True
+
+    def get_last_reading(self, key):
+        """Return the last good reading and its monotonic time, or (None, None) if there was none yet."""
+        with self.__condition:
+            sensor = self.__sensors.get(key)
+            if sensor is None:
+                return None, None
+            return sensor.last_reading, sensor.last_reading_time
+
+    def __push(self, due_time: float, sensor: ScheduledSensor):
+        heapq.heappush(self.__schedule, (due_time, next(self.__sequence), sensor))
+        self.__condition.notify()
+
+    def __schedule_loop(self):
+        while True:
+            with self.__condition:
+                while not self.__schedule or self.__schedule[0][0] > time.monotonic():
+                    timeout = self.__schedule[0][0] - time.monotonic() if self.__schedule else None
+                    self.__condition.wait(timeout)
+                due_time, _, sensor = heapq.heappop(self.__schedule)
+                if sensor.removed:
+                    continue
+            self.__executor.submit(self.__read, sensor, due_time)
+
+    def __read(self, sensor: ScheduledSensor, due_time: float):
+        start_time = time.monotonic()
+        try:
+            reading = sensor.read_function()
+        except Exception:
+            logging.exception("Failed to read sensor '%s'", sensor.key)
+            reading = None
+        end_time = time.monotonic()
+        sensor_reads.inc()
+        sensor_read_duration.observe(end_time - start_time)
+
+        with self.__condition:
+            if reading is None:
+                sensor_read_errors.inc()
+                next_due_time = end_time + sensor.retry_interval
+            else:
+                sensor.last_reading = reading
+                sensor.last_reading_time = end_time
+                # keep the sampling grid, unless the read took longer than the interval
+                next_due_time = max(due_time + sensor.interval, end_time)
+            if not sensor.removed:
+                self.__push(next_due_time, sensor)
+
+        if reading is not None:
+            try:
+                sensor.callback(reading)
+            except Exception:
+                logging.exception("Failed to handle reading of sensor '%s'", sensor.key)
@@ -0,0 +1,91 @@
+import atexit
+import json
+import logging
+import os
+import time
+from threading import Thread, Condition, Lock
+
+from core.metrics import REGISTRY
+
+DEFAULT_STATE_FILENAME = "state.json"
+DEFAULT_WRITE_DELAY = 5.0
+
+state_writes = REGISTRY.counter("state_store_writes_total", "Number of state snapshots written to disk")
+state_write_errors = REGISTRY.counter("state_store_write_errors_total", "Number of failed state snapshot writes")
+
+
+class StateStore:
+    """Keeps the last state of each device and persists all states as one json snapshot. Writes are delayed by the
+    write delay, so a burst of changes (e.g. a brightness slider) results in a single write. The snapshot is replaced
+    atomically, so a power loss leaves either the old or the new snapshot."""
+
+    def __init__(self, filename: str = DEFAULT_STATE_FILENAME, write_delay: float = DEFAULT_WRITE_DELAY):
+        self.__filename = filename
+        self.__write_delay = write_delay
+        self.__states = self.__load()
+        self.__dirty = False
+        self.__condition = Condition()
+        self.__write_lock = Lock()
+
+        self.__writer_thread = Thread(target=self.__write_worker, daemon=True)
+        self.__writer_thread.start()
+        atexit.register(self.flush)
+
+        logging.debug("StateStore created with %d states from '%s'", len(self.__states), filename)
+
+    def get(self, key: str):
+        with self.__condition:
+            return self.__states.get(key)
+
+    def update(self, key: str, state: dict):
+        """Store the state of a device. A snapshot write is only scheduled if the state differs from the stored one."""
+        # normalize tuples to lists, so states compare equal to the ones loaded from json
+        state = json.loads(json.dumps(state))
+        with self.__condition:
+            if self.__states.get(key) == state:
+                return
+            self.__states[key] = state
+            self.__dirty = True
+            self.__condition.notify()
+
+    def flush(self):
+        """Write pending changes now. A write of the writer thread in progress is waited for, so the snapshot is
+        complete once flush returns, e.g. on shutdown."""
+        with self.__write_lock:
+            with self.__condition:
+                if not self.__dirty:
+                    return
+                self.__dirty = False
+                states = dict(self.__states)
+            self.__write(states)
+
+    def __load(self):
+        try:
+            with open(self.__filename, "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            logging.exception("Failed to load states from '%s', starting without saved states", self.__filename)
+            return {}
+
+    def __write_worker(self):
+        while True:
+            with self.__condition:
+                while not self.__dirty:
+                    self.__condition.wait()
+            time.sleep(self.__write_delay)
+            self.flush()
+
+    def __write(self, states: dict):
+        temporary_filename = self.__filename + ".tmp"
+        try:
+            with open(temporary_filename, "w") as file:
+                json.dump(states, file, separators=(",", ":"))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary_filename, self.__filename)
+            state_writes.inc()
+        except OSError:
+            state_write_errors.inc()
+            logging.exception("Failed to write states to '%s'", self.__filename)
@@ -0,0 +1,90 @@
+from threading import Lock
+
+TOPIC_SEPARATOR = "/"
+SINGLE_LEVEL_WILDCARD = "+"
+MULTI_LEVEL_WILDCARD = "#"
+ROUTE_CACHE_SIZE = 4096
+
+
+class TopicTrieNode:
+    def __init__(self):
+        self.children = {}
+        self.callbacks = set()
+
+
+class TopicTrie:
+    """Prefix trie over the levels of mqtt topic filters. Filters may contain the '+' and '#' wildcards, matching
+    a topic walks the trie once per level. Matches are cached per topic until the trie is modified, so the routing
+    of recurring topics is a single dict lookup."""
+
+    def __init__(self):
+        self.__root = TopicTrieNode()
+        self.__route_cache = {}
+        self.__lock = Lock()
+
+    def add(self, topic_filter: str, callback):
+        with self.__lock:
+            node = self.__root
+            for level in topic_filter.split(TOPIC_SEPARATOR):
+                node = node.children.setdefault(level, TopicTrieNode())
+            node.callbacks.add(callback)
+            self.__route_cache = {}
+
+    def remove(self, topic_filter: str, callback) -> bool:
+        """Remove a callback of a filter. Returns True if no callbacks are left for the filter."""
+        with self.__lock:
+            path = [self.__root]
+            levels = topic_filter.split(TOPIC_SEPARATOR)
+            for level in levels:
+                node = path[-1].children.get(level)
+                if node is None:
+                    return True
+                path.append(node)
+            path[-1].callbacks.discard(callback)
+            is_unused = not path[-1].callbacks
+
+            # prune nodes which neither hold callbacks nor lead to other filters
+            for level, parent, node in zip(reversed(levels), reversed(path[:-1]), reversed(path[1:])):
+                if node.callbacks or node.children:
+                    break
+                del parent.children[level]
+            self.__route_cache = {}
+            return is_unused
+
+    def get_filters(self) -> ():
+        filters = []
+        self.__collect_filters(self.__root, [], filters)
+        return tuple(filters)
+
+    def match(self, topic: str) -> ():
+        """Return the callbacks of all filters matching the given topic."""
+        callbacks = self.__route_cache.get(topic)
+        if callbacks is None:
+            with self.__lock:
+                matched = set()
+                self.__match(self.__root, topic.split(TOPIC_SEPARATOR), 0, matched)
+                callbacks = tuple(matched)
+                if len(self.__route_cache) >= ROUTE_CACHE_SIZE:
+                    self.__route_cache = {}
+                self.__route_cache[topic] = callbacks
+        return callbacks
+
+    def __match(self, node: TopicTrieNode, levels: list, index: int, matched: set):
+        multi_level_node = node.children.get(MULTI_LEVEL_WILDCARD)
+        if multi_level_node is not None:
+            matched.update(multi_level_node.callbacks)
+
+        if index == len(levels):
+            matched.update(node.callbacks)
+            return
+
+        for level in (levels[index], SINGLE_LEVEL_WILDCARD):
+            child = node.children.get(level)
+            if child is not None:
+                self.__match(child, levels, index + 1, matched)
+
+    def __collect_filters(self, node: TopicTrieNode, levels: list, filters: list):
+        if node.callbacks:
+            filters.append(TOPIC_SEPARATOR.join(levels))
+        for level, child in node.children.items():
+            self.__collect_filters(child, levels + [level], filters)
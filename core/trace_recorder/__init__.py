@@ -0,0 +1,90 @@
+import atexit
+import gzip
+import json
+import logging
+import time
+from threading import Lock
+
+TRACE_VERSION = 1
+# payloads are stored as text; bytes which are no valid utf-8 survive the round trip as escaped surrogates
+PAYLOAD_ENCODING = "utf-8"
+PAYLOAD_ERRORS = "surrogateescape"
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+
+class TraceRecorder:
+    """Records received mqtt messages to a gzip compressed trace. The first line is a header, each further line is
+    a json array [offset, topic, payload] with the offset in seconds since the recording started. Lines are collected
+    and written as a complete gzip member at most every flush interval, so a crash only loses the last lines instead
+    of the whole trace."""
+
+    def __init__(self, filename: str, flush_interval: float = DEFAULT_FLUSH_INTERVAL):
+        self.__filename = filename
+        self.__flush_interval = flush_interval
+        self.__file = open(filename, "wb")
+        self.__pending_lines = []
+        self.__start_time = time.monotonic()
+        self.__last_flush_time = self.__start_time
+        self.__lock = Lock()
+        with self.__lock:
+            self.__write_line({"version": TRACE_VERSION, "started": time.time()})
+            self.__flush()
+        atexit.register(self.close)
+
+        logging.info("Recording mqtt trace to '%s'", filename)
+
+    def record(self, topic: str, payload: bytes, received_time: float = None):
+        if received_time is None:
+            received_time = time.monotonic()
+        with self.__lock:
+            if self.__file is not None:
+                self.__write_line([round(received_time - self.__start_time, 6), topic,
+                                   payload.decode(PAYLOAD_ENCODING, PAYLOAD_ERRORS)])
+                if time.monotonic() - self.__last_flush_time >= self.__flush_interval:
+                    self.__flush()
+
+    def flush(self):
+        with self.__lock:
+            if self.__file is not None:
+                self.__flush()
+
+    def close(self):
+        with self.__lock:
+            if self.__file is not None:
+                self.__flush()
+                self.__file.close()
+                self.__file = None
+
+    def __write_line(self, value):
+        self.__pending_lines.append(json.dumps(value, separators=(",", ":")) + "\n")
+
+    def __flush(self):
+        self.__last_flush_time = time.monotonic()
+        if not self.__pending_lines:
+            return
+        data = "".join(self.__pending_lines).encode("utf-8")
+        self.__pending_lines = []
+        try:
+            self.__file.write(gzip.compress(data))
+            self.__file.flush()
+        except OSError:
+            logging.exception("Failed to write mqtt trace to '%s'", self.__filename)
+
+
+def read_trace(filename: str):
+    """Yield the (offset, topic, payload) messages of a trace written by TraceRecorder. A trace cut off by a crash
+    is read up to its last complete line."""
+    with gzip.open(filename, "rt", encoding="utf-8") as file:
+        header = json.loads(file.readline())
+        if header.get("version") != TRACE_VERSION:
+            raise ValueError("Unsupported trace version '" + str(header.get("version")) + "'.")
+        try:
+            for line in file:
+                if not line.endswith("\n"):
+                    logging.warning("Ignoring incomplete last line of trace '%s'", filename)
+                    break
+                if line.strip():
+                    offset, topic, payload = json.loads(line)
+                    yield offset, topic, payload.encode(PAYLOAD_ENCODING, PAYLOAD_ERRORS)
+        except EOFError:
+            logging.warning("Trace '%s' is truncated, replaying it up to the last complete line", filename)
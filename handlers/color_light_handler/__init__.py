@@ -1,58 +1,125 @@
+import json
 import logging
-import time
-from threading import Thread
 
 from core.pi_pwm import PiPwm
+from core.fade_scheduler import FadeScheduler, DEFAULT_FADE_DURATION
 from core.mqtt_connector import MqttConnector
-from utils import logarithmic_fade
-
-FADE_STEPS = 60
-LOGARITHMIC_FADE_BASE = 5
+from core.brightness_curve import BrightnessCurve, create_curve
+from core.effects_engine import EffectsEngine, EFFECT_NONE
+from core.state_store import StateStore
+from core.command_schema import parse_power, parse_brightness, parse_color, parse_effect, parse_set_command, \
+    merge_set_payloads
 
 MQTT_TOPIC_COLOR_SUFFIX = "color"
 MQTT_TOPIC_POWER_SUFFIX = "power"
 MQTT_TOPIC_BRIGHTNESS_SUFFIX = "brightness"
+MQTT_TOPIC_EFFECT_SUFFIX = "effect"
+MQTT_TOPIC_STATE_SUFFIX = "state"
+MQTT_TOPIC_SET_SUFFIX = "set"
+MQTT_MESSAGE_ON = "ON"
+MQTT_MESSAGE_OFF = "OFF"
 
 
 class ColorLightHandler:
-    def __init__(self, mqtt_connector: MqttConnector, pwm: PiPwm, mqtt_basetopic: str,
-                 id: str, channel_ids: (), value_range: int):
+    def __init__(self, mqtt_connector: MqttConnector, pwm: PiPwm, fade_scheduler: FadeScheduler, mqtt_basetopic: str,
+                 id: str, channel_ids: (), value_range: int, fade_duration: float = DEFAULT_FADE_DURATION,
+                 brightness_curve: BrightnessCurve = None, effects_engine: EffectsEngine = None,
+                 state_store: StateStore = None):
         self.__id = id
         self.__channel_ids = channel_ids
         self.__pwm = pwm
+        self.__fade_scheduler = fade_scheduler
         self.__value_range = value_range
-
-        self.__fade_thread = None
-        self.__stop_thread_trigger = False
+        self.__fade_duration = fade_duration
+        self.__brightness_curve = brightness_curve if brightness_curve is not None else create_curve()
+        self.__effects_engine = effects_engine
 
         self.__current_rgb_values = (0,) * len(channel_ids)
         self.__last_state_rgb_values = (0,) * len(channel_ids)
         self.__current_brightness = 0.0
         self.__last_state_brightness = 0.0
         self.__light_state_on = False
+        self.__last_state_effect = None
+        self.__state_store = state_store
+        self.__state_topic = mqtt_basetopic + "/" + id + "/" + MQTT_TOPIC_STATE_SUFFIX
+        self.__published_state = None
 
         logging.debug("Init LedStripLight with name %s", id)
-        mqtt_connector.subscribe_to_topic(mqtt_basetopic + "/" + id + "/" + MQTT_TOPIC_POWER_SUFFIX,
-                                          self.__handle_power_command)
-        mqtt_connector.subscribe_to_topic(mqtt_basetopic + "/" + id + "/" + MQTT_TOPIC_COLOR_SUFFIX,
-                                          self.__handle_color_command)
-        mqtt_connector.subscribe_to_topic(mqtt_basetopic + "/" + id + "/" + MQTT_TOPIC_BRIGHTNESS_SUFFIX,
-                                          self.__handle_brightness_command)
+        self.__mqtt_connector = mqtt_connector
+        self.__subscriptions = [
+            (mqtt_basetopic + "/" + id + "/" + MQTT_TOPIC_POWER_SUFFIX, self.__handle_power_command, None),
+            (mqtt_basetopic + "/" + id + "/" + MQTT_TOPIC_COLOR_SUFFIX, self.__handle_color_command, None),
+            (mqtt_basetopic + "/" + id + "/" + MQTT_TOPIC_BRIGHTNESS_SUFFIX, self.__handle_brightness_command, None),
+            (mqtt_basetopic + "/" + id + "/" + MQTT_TOPIC_SET_SUFFIX, self.__handle_set_command, merge_set_payloads),
+        ]
+        if effects_engine is not None:
+            self.__subscriptions.append(
+                (mqtt_basetopic + "/" + id + "/" + MQTT_TOPIC_EFFECT_SUFFIX, self.__handle_effect_command, None))
+        for topic, callback, merge_function in self.__subscriptions:
+            mqtt_connector.subscribe_to_topic(topic, callback, merge_function)
+
+    def close(self):
+        """Unsubscribe from all topics and stop running fades and effects. The outputs keep their current values."""
+        for topic, callback, _ in self.__subscriptions:
+            self.__mqtt_connector.unsubscribe_from_topic(topic, callback)
+        self.__fade_scheduler.cancel(self)
+        if self.__effects_engine is not None:
+            self.__effects_engine.stop(self)
+
+    def get_state(self) -> dict:
+        """Return the last commanded state. Brightness and color components are fractions between 0 and 1, so the
+        state can be restored with a different value range."""
+        return {
+            "power": self.__light_state_on,
+            "brightness": self.__last_state_brightness,
+            "color": tuple(value / self.__value_range for value in self.__last_state_rgb_values),
+            "effect": self.__last_state_effect,
+            "current_values": tuple(self.__current_rgb_values),
+        }
+
+    def get_state_topic(self):
+        return self.__state_topic
+
+    def restore_state(self, state: dict):
+        """Take over a state returned by get_state and bring the outputs to it without a fade."""
+        current_values = state.get("current_values")
+        if current_values is not None and len(current_values) == len(self.__channel_ids):
+            self.__current_rgb_values = tuple(current_values)
+        color = state.get("color")
+        rgb_values = None
+        if color is not None and len(color) == len(self.__channel_ids):
+            rgb_values = tuple(round(component * self.__value_range) for component in color)
+        self.__update_state(power=bool(state.get("power", False)), brightness=state.get("brightness"),
+                            rgb_values=rgb_values, duration=0, effect=state.get("effect") or EFFECT_NONE)
 
     def is_fading(self):
-        return self.__fade_thread is not None and self.__fade_thread.is_alive()
+        return self.__fade_scheduler.is_fading(self)
 
     def is_on(self):
         return self.__light_state_on
 
-    def fade_to_colors(self, rgb_state: (int, int, int), brightness: float):
-        if self.is_fading():
-            self.__stop_fading()
-
+    def fade_to_colors(self, rgb_state: (int, int, int), brightness: float, duration: float = None):
         logging.debug("Start fading for light '%s'...", self.__id)
-        self.__stop_thread_trigger = False
-        self.__fade_thread = Thread(target=self.__do_fade, args=(rgb_state, brightness, lambda: self.__stop_thread_trigger))
-        self.__fade_thread.start()
+        if self.__effects_engine is not None:
+            effect_values = self.__effects_engine.stop(self)
+            if effect_values is not None:
+                self.__current_rgb_values = effect_values
+        target_values = self.__get_target_values(rgb_state, brightness)
+        self.__fade_scheduler.fade(self, self.__channel_ids, self.__current_rgb_values, target_values,
+                                   duration=self.__fade_duration if duration is None else duration,
+                                   output_table=self.__brightness_curve.get_table(), on_frame=self.__on_fade_frame)
+
+    def apply_state(self, power: bool = None, brightness: float = None, color: () = None, duration: float = None,
+                    effect: str = None):
+        """Apply a combined state change with a single fade. Brightness and color components are given as fractions
+        between 0 and 1; values which are not given keep their last state."""
+        rgb_values = None
+        if color is not None and len(color) != len(self.__channel_ids):
+            logging.warning("Ignoring color with %d components for light '%s' with %d channels", len(color),
+                            self.__id, len(self.__channel_ids))
+        elif color is not None:
+            rgb_values = tuple(round(component * self.__value_range) for component in color)
+        self.__update_state(power, brightness, rgb_values, duration, effect)
 
     def get_current_rgb_values(self):
         return self.__current_rgb_values
@@ -61,63 +128,94 @@ class ColorLightHandler:
         return self.__channel_ids
 
     def __handle_power_command(self, message):
-        light_state = str(message.decode("utf-8"))
-        logging.debug("Handle power command for light '%s': %s", self.__id, light_state)
-
-        if light_state == "ON":
-            self.__light_state_on = True
-            self.fade_to_colors(self.__last_state_rgb_values, self.__last_state_brightness)
-        else:
-            self.__light_state_on = False
-            self.fade_to_colors(self.__last_state_rgb_values, 0.0)
+        logging.debug("Handle power command for light '%s': %s", self.__id, message)
+        try:
+            self.__update_state(power=parse_power(message))
+        except ValueError as error:
+            logging.warning("Ignoring invalid power command for light '%s': %s", self.__id, error)
 
     def __handle_color_command(self, message):
-        color_state = str(message.decode("utf-8"))
-        logging.debug("Handle color command for light %s: %s", self.__id, color_state)
-        values = color_state.split(";")
-        new_colors = ()
-
-        for value in values:
-            new_colors = new_colors + (int(float(value)),)
-
-        self.__last_state_rgb_values = new_colors
-        if self.__light_state_on:
-            self.fade_to_colors(new_colors, self.__last_state_brightness)
+        logging.debug("Handle color command for light %s: %s", self.__id, message)
+        try:
+            self.apply_state(color=parse_color(message, self.__value_range))
+        except ValueError as error:
+            logging.warning("Ignoring invalid color command for light '%s': %s", self.__id, error)
 
     def __handle_brightness_command(self, message):
-        brightness_state = str(message.decode("utf-8"))
-        logging.debug("Handle brightness command for light %s: %s", self.__id, brightness_state)
-        new_brightness = float(brightness_state) / self.__value_range
-
-        self.__last_state_brightness = new_brightness
-        if self.__light_state_on:
-            self.fade_to_colors(self.__last_state_rgb_values, new_brightness)
-
-    def __stop_fading(self):
-        if self.is_fading():
-            self.__stop_thread_trigger = True
-            self.__fade_thread.join()
-            logging.debug("Cancelled fading for light '%s'...", self.__id)
-
-    def __do_fade(self, target_rgb_values: (), target_brightness: float, stop):
-        initial = ()
-        diff = ()
-        for i in range(0, len(self.__current_rgb_values)):
-            initial = initial + (self.__current_rgb_values[i],)
-            target = target_rgb_values[i] / self.__value_range * 4095 * target_brightness
-            diff = diff + (target - initial[i],)
-
-        for step in range(0, FADE_STEPS):
-            current = ()
-            for i in range(0, len(self.__current_rgb_values)):
-                value = int(initial[i] + (step + 1) * (diff[i] / FADE_STEPS))
-                current = current + (value,)
-                logarithmic_value = logarithmic_fade(value, 4095, 4095, LOGARITHMIC_FADE_BASE)
-                self.__pwm.set_pwm_channel_value(self.__channel_ids[i], logarithmic_value)
-            self.__current_rgb_values = current
-
-            if stop():
-                break
-
-            time.sleep(0.005)
-        logging.debug("Finished fading for light '%s'...", self.__id)
+        logging.debug("Handle brightness command for light %s: %s", self.__id, message)
+        try:
+            self.__update_state(brightness=parse_brightness(message, self.__value_range))
+        except ValueError as error:
+            logging.warning("Ignoring invalid brightness command for light '%s': %s", self.__id, error)
+
+    def __handle_effect_command(self, message):
+        logging.debug("Handle effect command for light %s: %s", self.__id, message)
+        try:
+            self.__update_state(effect=parse_effect(message))
+        except ValueError as error:
+            logging.warning("Ignoring invalid effect command for light '%s': %s", self.__id, error)
+
+    def __handle_set_command(self, message):
+        logging.debug("Handle set command for light %s: %s", self.__id, message)
+        try:
+            command = parse_set_command(message, self.__value_range)
+        except ValueError as error:
+            logging.warning("Ignoring invalid set command for light '%s': %s", self.__id, error)
+            return
+        self.apply_state(command.power, command.brightness, command.color, command.transition, command.effect)
+
+    def __update_state(self, power: bool = None, brightness: float = None, rgb_values: () = None,
+                       duration: float = None, effect: str = None):
+        if effect is not None:
+            if effect == EFFECT_NONE:
+                self.__last_state_effect = None
+            elif self.__effects_engine is not None and effect in EffectsEngine.EFFECTS:
+                self.__last_state_effect = effect
+            else:
+                logging.warning("Unsupported effect '%s' for light '%s'", effect, self.__id)
+        if rgb_values is not None:
+            self.__last_state_rgb_values = rgb_values
+        if brightness is not None:
+            self.__last_state_brightness = brightness
+        if power is not None:
+            self.__light_state_on = power
+
+        if self.__light_state_on and self.__last_state_effect is not None:
+            self.__start_effect()
+        elif self.__light_state_on:
+            self.fade_to_colors(self.__last_state_rgb_values, self.__last_state_brightness, duration)
+        elif power is not None:
+            self.fade_to_colors(self.__last_state_rgb_values, 0.0, duration)
+        self.__on_state_change()
+
+    def __on_state_change(self):
+        """Save the state and publish it to the retained state topic, if it changed since the last publish."""
+        if self.__state_store is not None:
+            state = self.get_state()
+            del state["current_values"]
+            self.__state_store.update(self.__state_topic, state)
+
+        published_state = json.dumps({
+            "state": MQTT_MESSAGE_ON if self.__light_state_on else MQTT_MESSAGE_OFF,
+            "brightness": round(self.__last_state_brightness * self.__value_range),
+            "color": list(self.__last_state_rgb_values),
+            "effect": self.__last_state_effect if self.__last_state_effect is not None else EFFECT_NONE,
+        }, separators=(",", ":"))
+        if published_state != self.__published_state:
+            self.__published_state = published_state
+            self.__mqtt_connector.publish(self.__state_topic, published_state, retain=True)
+
+    def __start_effect(self):
+        logging.debug("Start effect '%s' for light '%s'...", self.__last_state_effect, self.__id)
+        target_values = self.__get_target_values(self.__last_state_rgb_values, self.__last_state_brightness)
+        self.__fade_scheduler.cancel(self)
+        self.__effects_engine.start(self, self.__last_state_effect, self.__channel_ids, target_values,
+                                    self.__brightness_curve.get_table())
+        # fades started before the first effect frame is written begin at the effect's base values
+        self.__current_rgb_values = tuple(int(value) for value in target_values)
+
+    def __get_target_values(self, rgb_state: (), brightness: float):
+        return tuple(value / self.__value_range * 4095 * brightness for value in rgb_state)
+
+    def __on_fade_frame(self, current_rgb_values: ()):
+        self.__current_rgb_values = current_rgb_values
@@ -0,0 +1,63 @@
+import logging
+
+from core.mqtt_connector import MqttConnector
+from core.sensor_scheduler import SensorScheduler
+
+MQTT_TOPIC_TEMPERATURE_SUFFIX = "temperature"
+MQTT_TOPIC_HUMIDITY_SUFFIX = "humidity"
+
+DEFAULT_INTERVAL = 30.0
+DEFAULT_TEMPERATURE_THRESHOLD = 0.2
+DEFAULT_HUMIDITY_THRESHOLD = 1.0
+
+
+class DhtHandler:
+    """Publishes temperature and humidity of a DHT sensor sampled by the sensor scheduler. A value is only published
+    if it differs from the last published one by at least its threshold."""
+
+    def __init__(self, mqtt_connector: MqttConnector, sensor_scheduler: SensorScheduler, dht_backend,
+                 mqtt_basetopic: str, id: str, interval: float = DEFAULT_INTERVAL,
+                 temperature_threshold: float = DEFAULT_TEMPERATURE_THRESHOLD,
+                 humidity_threshold: float = DEFAULT_HUMIDITY_THRESHOLD):
+        self.__id = id
+        self.__mqtt_connector = mqtt_connector
+        self.__sensor_scheduler = sensor_scheduler
+        self.__dht_backend = dht_backend
+        self.__temperature_topic = mqtt_basetopic + "/" + id + "/" + MQTT_TOPIC_TEMPERATURE_SUFFIX
+        self.__humidity_topic = mqtt_basetopic + "/" + id + "/" + MQTT_TOPIC_HUMIDITY_SUFFIX
+        self.__temperature_threshold = temperature_threshold
+        self.__humidity_threshold = humidity_threshold
+        self.__published_temperature = None
+        self.__published_humidity = None
+
+        sensor_scheduler.add(self, self.__read, interval, self.__handle_reading)
+
+        logging.debug("Init DhtHandler with name %s", id)
+
+    def close(self):
+        self.__sensor_scheduler.remove(self)
+
+    def get_reading(self):
+        """Return the last good (humidity, temperature) reading, or None if there was none yet."""
+        reading, _ = self.__sensor_scheduler.get_last_reading(self)
+        return reading
+
+    def __read(self):
+        humidity, temperature = self.__dht_backend.read()
+        # the sensors occasionally return implausible values instead of failing
+        if humidity is None or temperature is None or not 0.0 <= humidity <= 100.0:
+            return None
+        return humidity, temperature
+
+    def __handle_reading(self, reading: (float, float)):
+        humidity, temperature = reading
+        if self.__published_temperature is None or \
+                abs(temperature - self.__published_temperature) >= self.__temperature_threshold:
+            self.__published_temperature = temperature
+            self.__mqtt_connector.publish(self.__temperature_topic, "{:.1f}".format(temperature), retain=True)
+            logging.debug("DHT '%s' temperature changed to: %.1f", self.__id, temperature)
+        if self.__published_humidity is None or \
+                abs(humidity - self.__published_humidity) >= self.__humidity_threshold:
+            self.__published_humidity = humidity
+            self.__mqtt_connector.publish(self.__humidity_topic, "{:.1f}".format(humidity), retain=True)
+            logging.debug("DHT '%s' humidity changed to: %.1f", self.__id, humidity)
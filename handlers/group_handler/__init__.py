@@ -0,0 +1,76 @@
+import logging
+
+from core.fade_scheduler import FadeScheduler
+from core.mqtt_connector import MqttConnector
+from core.command_schema import parse_power, parse_brightness, parse_color, parse_set_command, merge_set_payloads
+
+MQTT_TOPIC_COLOR_SUFFIX = "color"
+MQTT_TOPIC_POWER_SUFFIX = "power"
+MQTT_TOPIC_BRIGHTNESS_SUFFIX = "brightness"
+MQTT_TOPIC_SET_SUFFIX = "set"
+
+
+class GroupHandler:
+    """Maps the commands of one group topic onto its member devices within one fade scheduler batch."""
+
+    def __init__(self, mqtt_connector: MqttConnector, fade_scheduler: FadeScheduler, mqtt_basetopic: str,
+                 id: str, members: (), value_range: int):
+        self.__id = id
+        self.__members = members
+        self.__fade_scheduler = fade_scheduler
+        self.__value_range = value_range
+
+        logging.debug("Init GroupHandler with name %s", id)
+        self.__mqtt_connector = mqtt_connector
+        self.__subscriptions = (
+            (mqtt_basetopic + "/" + id + "/" + MQTT_TOPIC_POWER_SUFFIX, self.__handle_power_command, None),
+            (mqtt_basetopic + "/" + id + "/" + MQTT_TOPIC_COLOR_SUFFIX, self.__handle_color_command, None),
+            (mqtt_basetopic + "/" + id + "/" + MQTT_TOPIC_BRIGHTNESS_SUFFIX, self.__handle_brightness_command, None),
+            (mqtt_basetopic + "/" + id + "/" + MQTT_TOPIC_SET_SUFFIX, self.__handle_set_command, merge_set_payloads),
+        )
+        for topic, callback, merge_function in self.__subscriptions:
+            mqtt_connector.subscribe_to_topic(topic, callback, merge_function)
+
+    def close(self):
+        for topic, callback, _ in self.__subscriptions:
+            self.__mqtt_connector.unsubscribe_from_topic(topic, callback)
+
+    def get_members(self):
+        return self.__members
+
+    def apply_state(self, power: bool = None, brightness: float = None, color: () = None, duration: float = None,
+                    effect: str = None):
+        with self.__fade_scheduler.batch():
+            for member in self.__members:
+                member.apply_state(power=power, brightness=brightness, color=color, duration=duration,
+                                   effect=effect)
+
+    def __handle_power_command(self, message):
+        logging.debug("Handle power command for group '%s': %s", self.__id, message)
+        try:
+            self.apply_state(power=parse_power(message))
+        except ValueError as error:
+            logging.warning("Ignoring invalid power command for group '%s': %s", self.__id, error)
+
+    def __handle_color_command(self, message):
+        logging.debug("Handle color command for group %s: %s", self.__id, message)
+        try:
+            self.apply_state(color=parse_color(message, self.__value_range))
+        except ValueError as error:
+            logging.warning("Ignoring invalid color command for group '%s': %s", self.__id, error)
+
+    def __handle_brightness_command(self, message):
+        logging.debug("Handle brightness command for group %s: %s", self.__id, message)
+        try:
+            self.apply_state(brightness=parse_brightness(message, self.__value_range))
+        except ValueError as error:
+            logging.warning("Ignoring invalid brightness command for group '%s': %s", self.__id, error)
+
+    def __handle_set_command(self, message):
+        logging.debug("Handle set command for group %s: %s", self.__id, message)
+        try:
+            command = parse_set_command(message, self.__value_range)
+        except ValueError as error:
+            logging.warning("Ignoring invalid set command for group '%s': %s", self.__id, error)
+            return
+        self.apply_state(command.power, command.brightness, command.color, command.transition, command.effect)
@@ -1,36 +1,102 @@
+import json
 import logging
 
 from core.pi_pwm import PiPwm
+from core.fade_scheduler import FadeScheduler
 from core.mqtt_connector import MqttConnector
+from core.state_store import StateStore
+from core.command_schema import parse_power, parse_set_command, merge_set_payloads
 
 MQTT_TOPIC_POWER_SUFFIX = "power"
+MQTT_TOPIC_STATE_SUFFIX = "state"
+MQTT_TOPIC_SET_SUFFIX = "set"
+MQTT_MESSAGE_ON = "ON"
+MQTT_MESSAGE_OFF = "OFF"
 
 
 class OnOffHandler:
-    def __init__(self, mqtt_connector: MqttConnector, pwm: PiPwm, mqtt_basetopic: str,
-                 id: str, channel_id: int):
+    def __init__(self, mqtt_connector: MqttConnector, pwm: PiPwm, fade_scheduler: FadeScheduler, mqtt_basetopic: str,
+                 id: str, channel_id: int, state_store: StateStore = None):
         self.__id = id
         self.__channel_id = channel_id
         self.__pwm = pwm
+        self.__fade_scheduler = fade_scheduler
 
         self.__current_state_on = False
+        self.__state_store = state_store
+        self.__state_topic = mqtt_basetopic + "/" + id + "/" + MQTT_TOPIC_STATE_SUFFIX
+        self.__published_state = None
 
         logging.debug("Init OnOffHandler with name %s", id)
-        mqtt_connector.subscribe_to_topic(mqtt_basetopic + "/" + id + "/" + MQTT_TOPIC_POWER_SUFFIX,
-                                          self.__handle_power_command)
+        self.__mqtt_connector = mqtt_connector
+        self.__subscriptions = (
+            (mqtt_basetopic + "/" + id + "/" + MQTT_TOPIC_POWER_SUFFIX, self.__handle_power_command, None),
+            (mqtt_basetopic + "/" + id + "/" + MQTT_TOPIC_SET_SUFFIX, self.__handle_set_command, merge_set_payloads),
+        )
+        for topic, callback, merge_function in self.__subscriptions:
+            mqtt_connector.subscribe_to_topic(topic, callback, merge_function)
+
+    def close(self):
+        """Unsubscribe from all topics. The output keeps its current value."""
+        for topic, callback, _ in self.__subscriptions:
+            self.__mqtt_connector.unsubscribe_from_topic(topic, callback)
+        self.__fade_scheduler.cancel(self)
+
+    def get_state(self) -> dict:
+        return {"power": self.__current_state_on}
+
+    def get_state_topic(self):
+        return self.__state_topic
+
+    def restore_state(self, state: dict):
+        # start from the opposite state, so the target value is written regardless of the current output
+        self.__current_state_on = not state.get("power", False)
+        self.set_on(bool(state.get("power", False)))
 
     def is_on(self):
         return self.__current_state_on
 
     def set_on(self, state_on: bool):
+        # switched via the fade scheduler without transition, so the switch is rendered in the same frame as
+        # the fades of a group or scene
+        current_value = PiPwm.CHANNEL_VALUE_MAX if self.__current_state_on else PiPwm.CHANNEL_VALUE_MIN
         self.__current_state_on = state_on
-        self.__pwm.set_pwm_channel_bool(self.__channel_id, self.__current_state_on)
+        target_value = PiPwm.CHANNEL_VALUE_MAX if self.__current_state_on else PiPwm.CHANNEL_VALUE_MIN
+        self.__fade_scheduler.fade(self, (self.__channel_id,), (current_value,), (target_value,), duration=0)
         logging.debug("Set state for channel id '%s' to: %s.", self.__id, "ON" if self.__current_state_on else "OFF")
+        self.__on_state_change()
+
+    def apply_state(self, power: bool = None, brightness: float = None, color: () = None, duration: float = None,
+                    effect: str = None):
+        """Apply a state change. Only the power state is supported, brightness, color and effect are ignored."""
+        if power is not None:
+            self.set_on(power)
 
     def get_channel_ids(self):
-        return self.__channel_id
+        return (self.__channel_id,)
+
+    def __on_state_change(self):
+        if self.__state_store is not None:
+            self.__state_store.update(self.__state_topic, self.get_state())
+
+        published_state = json.dumps({"state": MQTT_MESSAGE_ON if self.__current_state_on else MQTT_MESSAGE_OFF},
+                                     separators=(",", ":"))
+        if published_state != self.__published_state:
+            self.__published_state = published_state
+            self.__mqtt_connector.publish(self.__state_topic, published_state, retain=True)
 
     def __handle_power_command(self, message):
-        state_string = str(message.decode("utf-8"))
-        logging.debug("Handle power command for channel id '%s': %s", self.__id, state_string)
-        self.set_on(state_string == "ON")
+        logging.debug("Handle power command for channel id '%s': %s", self.__id, message)
+        try:
+            self.set_on(parse_power(message))
+        except ValueError as error:
+            logging.warning("Ignoring invalid power command for channel id '%s': %s", self.__id, error)
+
+    def __handle_set_command(self, message):
+        logging.debug("Handle set command for channel id '%s': %s", self.__id, message)
+        try:
+            command = parse_set_command(message, 1)
+        except ValueError as error:
+            logging.warning("Ignoring invalid set command for channel id '%s': %s", self.__id, error)
+            return
+        self.apply_state(power=command.power)
@@ -0,0 +1,78 @@
+import logging
+
+from core.fade_scheduler import FadeScheduler
+from core.mqtt_connector import MqttConnector
+from core.command_schema import parse_power, parse_set_command, merge_set_payloads
+
+MQTT_TOPIC_POWER_SUFFIX = "power"
+MQTT_TOPIC_SET_SUFFIX = "set"
+
+
+class SceneState:
+    """Target state of one scene member. Brightness and color components are fractions between 0 and 1, None
+    keeps the current value of the member."""
+
+    def __init__(self, power: bool, brightness: float = None, color: () = None):
+        self.power = power
+        self.brightness = brightness
+        self.color = color
+
+
+class SceneHandler:
+    """Applies a predefined state to its member devices within one fade scheduler batch."""
+
+    def __init__(self, mqtt_connector: MqttConnector, fade_scheduler: FadeScheduler, mqtt_basetopic: str,
+                 id: str, member_states: (), duration: float = None):
+        self.__id = id
+        self.__member_states = member_states
+        self.__fade_scheduler = fade_scheduler
+        self.__duration = duration
+
+        logging.debug("Init SceneHandler with name %s", id)
+        self.__mqtt_connector = mqtt_connector
+        self.__subscriptions = (
+            (mqtt_basetopic + "/" + id + "/" + MQTT_TOPIC_POWER_SUFFIX, self.__handle_power_command, None),
+            (mqtt_basetopic + "/" + id + "/" + MQTT_TOPIC_SET_SUFFIX, self.__handle_set_command, merge_set_payloads),
+        )
+        for topic, callback, merge_function in self.__subscriptions:
+            mqtt_connector.subscribe_to_topic(topic, callback, merge_function)
+
+    def close(self):
+        for topic, callback, _ in self.__subscriptions:
+            self.__mqtt_connector.unsubscribe_from_topic(topic, callback)
+
+    def activate(self, duration: float = None):
+        duration = self.__duration if duration is None else duration
+        with self.__fade_scheduler.batch():
+            for member, state in self.__member_states:
+                member.apply_state(power=state.power, brightness=state.brightness, color=state.color,
+                                   duration=duration)
+
+    def deactivate(self, duration: float = None):
+        duration = self.__duration if duration is None else duration
+        with self.__fade_scheduler.batch():
+            for member, _ in self.__member_states:
+                member.apply_state(power=False, duration=duration)
+
+    def apply_state(self, power: bool = None, brightness: float = None, color: () = None, duration: float = None,
+                    effect: str = None):
+        if power is True:
+            self.activate(duration)
+        elif power is False:
+            self.deactivate(duration)
+
+    def __handle_power_command(self, message):
+        logging.debug("Handle power command for scene '%s': %s", self.__id, message)
+        try:
+            self.apply_state(power=parse_power(message))
+        except ValueError as error:
+            logging.warning("Ignoring invalid power command for scene '%s': %s", self.__id, error)
+
+    def __handle_set_command(self, message):
+        logging.debug("Handle set command for scene '%s': %s", self.__id, message)
+        try:
+            command = parse_set_command(message, 1)
+        except ValueError as error:
+            logging.warning("Ignoring invalid set command for scene '%s': %s", self.__id, error)
+            return
+        self.apply_state(power=command.power, duration=command.transition)
@@ -1,19 +1,41 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import re
-import time
+import select
+import signal
+import socket
 import logging
 
-from configparser import ConfigParser
+from configparser import ConfigParser, NoOptionError
 from ast import literal_eval
-from core.mqtt_connector import MqttConnector
-from core.pi_pwm import PiPwm
+from core.mqtt_connector import MqttConnector, MQTT_VERSION_311, DEFAULT_SESSION_EXPIRY, DEFAULT_PUBLISH_WINDOW
+from core.outbox import DEFAULT_OUTBOX_SIZE
+from core.trace_recorder import TraceRecorder
+from core.command_dispatcher import CommandDispatcher
+from core.device_registry import DeviceRegistry
+from core.state_store import StateStore, DEFAULT_STATE_FILENAME, DEFAULT_WRITE_DELAY
+from core.metrics import MetricsServer, SamplingProfiler
+from core.pi_pwm import PiPwm, BoardConfig, DEFAULT_BOARD_ADDRESS, DEFAULT_PWM_FREQUENCY
+from core.fade_scheduler import FadeScheduler, DEFAULT_FADE_DURATION, DEFAULT_FRAME_RATE
+from core.pwm_backend import BACKEND_HARDWARE
+from core.pwm_output_process import SharedMemoryPwm, DEFAULT_OUTPUT_FRAME_RATE
+from core.gpio_backend import create_gpio_backend
+from core.sensor_scheduler import SensorScheduler, DEFAULT_READ_WORKERS
+from core.dht_backend import create_dht_backend, SENSOR_DHT22
+from core.gpio_monitor import GpioMonitor, DEFAULT_DEBOUNCE, DEFAULT_HOLD_TIME, DEFAULT_POLL_INTERVAL
+from core.effects_engine import EffectsEngine, DEFAULT_EFFECT_FRAME_RATE
+from core.brightness_curve import create_curve, CURVE_EXPONENTIAL, DEFAULT_EXPONENTIAL_BASE, DEFAULT_GAMMA
 
 from handlers.color_light_handler import ColorLightHandler
 from handlers.dimmable_light_handler import DimmableLightHandler
 from handlers.on_off_handler import OnOffHandler
 from handlers.pir_handler import PirHandler
+from handlers.dht_handler import DhtHandler, DEFAULT_INTERVAL, DEFAULT_TEMPERATURE_THRESHOLD, \
+    DEFAULT_HUMIDITY_THRESHOLD
+from handlers.group_handler import GroupHandler
+from handlers.scene_handler import SceneHandler, SceneState
 
 CONFIG_FILENAME = 'config.ini'
 
@@ -21,9 +43,14 @@ SECTION_GENERAL = "general"
 
 OPTION_TYPE = "type"
 DEVICE_TYPE_PIR = "pir"
+DEVICE_TYPE_DHT = "dht"
 DEVICE_TYPE_ON_OFF = "on-off"
 DEVICE_TYPE_COLOR_LIGHT = "color-light"
 DEVICE_TYPE_DIMMABLE_LIGHT = "dimmable-light"
+DEVICE_TYPE_GROUP = "group"
+DEVICE_TYPE_SCENE = "scene"
+# composite devices refer to other devices and are therefore created last
+COMPOSITE_DEVICE_TYPES = (DEVICE_TYPE_GROUP, DEVICE_TYPE_SCENE)
 OPTION_BASE_TOPIC = "base_topic"
 
 OPTION_MQTT_PROTOCOL = "mqtt_protocol"
@@ -31,8 +58,40 @@ OPTION_PIN = "pin"
 OPTION_PINS = "pins"
 OPTION_ID = "id"
 OPTION_VALUE_RANGE = "value_range"
+OPTION_MEMBERS = "members"
+OPTION_FADE_DURATION = "fade_duration"
+OPTION_FADE_FRAME_RATE = "fade_frame_rate"
+OPTION_EFFECT_FRAME_RATE = "effect_frame_rate"
+OPTION_CURVE = "curve"
+OPTION_CURVE_BASE = "curve_base"
+OPTION_CURVE_GAMMA = "curve_gamma"
+OPTION_CURVE_POINTS = "curve_points"
+OPTION_ADDRESS = "address"
+OPTION_BUSNUM = "busnum"
+OPTION_FREQUENCY = "frequency"
+OPTION_DEBOUNCE = "debounce"
+OPTION_HOLD_TIME = "hold_time"
+OPTION_SENSOR = "sensor"
+OPTION_INTERVAL = "interval"
+OPTION_TEMPERATURE_THRESHOLD = "temperature_threshold"
+OPTION_HUMIDITY_THRESHOLD = "humidity_threshold"
+OPTION_GPIO_POLL_INTERVAL = "gpio_poll_interval"
+OPTION_BACKEND = "backend"
+OPTION_OUTPUT_PROCESS = "output_process"
+OPTION_OUTPUT_FRAME_RATE = "output_frame_rate"
+OPTION_METRICS_HOST = "metrics_host"
+OPTION_METRICS_PORT = "metrics_port"
+OPTION_PROFILER_INTERVAL = "profiler_interval"
+OPTION_CONFIG_WATCH_INTERVAL = "config_watch_interval"
+OPTION_STATE_FILE = "state_file"
+OPTION_STATE_WRITE_DELAY = "state_write_delay"
+OPTION_TRACE_FILE = "trace_file"
 OPTION_MQTT_PORT = "mqtt_port"
 OPTION_MQTT_HOST = "mqtt_host"
+OPTION_MQTT_VERSION = "mqtt_version"
+OPTION_MQTT_SESSION_EXPIRY = "mqtt_session_expiry"
+OPTION_MQTT_OUTBOX_SIZE = "mqtt_outbox_size"
+OPTION_MQTT_PUBLISH_WINDOW = "mqtt_publish_window"
 
 logging.basicConfig(
     format='%(asctime)s %(levelname)-8s %(message)s',
@@ -42,76 +101,445 @@ logging.root.setLevel(logging.INFO)
 
 mqtt_conn = None
 pwm = None
+fade_scheduler = None
+effects_engine = None
+command_dispatcher = None
+gpio_monitor = None
+sensor_scheduler = None
+device_registry = None
+state_store = None
+metrics_server = None
+config_filename = CONFIG_FILENAME
+device_configs = {}
+reload_requested = False
+config_watch_interval = None
 
+backend = BACKEND_HARDWARE
+gpio_poll_interval = DEFAULT_POLL_INTERVAL
 
-def initialize():
-    global mqtt_conn, pwm
+
+def create_brightness_curve(options):
+    curve_type = options.get(OPTION_CURVE, fallback=CURVE_EXPONENTIAL)
+    curve_base = options.getfloat(OPTION_CURVE_BASE, fallback=DEFAULT_EXPONENTIAL_BASE)
+    curve_gamma = options.getfloat(OPTION_CURVE_GAMMA, fallback=DEFAULT_GAMMA)
+    curve_points = options.get(OPTION_CURVE_POINTS, fallback=None)
+    if curve_points is not None:
+        curve_points = literal_eval(curve_points)
+    return create_curve(curve_type, base=curve_base, gamma=curve_gamma, calibration_points=curve_points)
+
+
+def get_required_option(options, option):
+    value = options.get(option, fallback=None)
+    if value is None:
+        raise NoOptionError(option, options.name)
+    return value
+
+
+def read_board_configs(parser):
+    board_configs = []
+    for section_name in parser.sections():
+        board_match = re.search('board:(.*)', section_name, re.IGNORECASE)
+        if board_match:
+            board_name = board_match.group(1)
+            board_address = int(parser.get(section_name, OPTION_ADDRESS, fallback=str(DEFAULT_BOARD_ADDRESS)), 0)
+            board_busnum = parser.getint(section_name, OPTION_BUSNUM, fallback=None)
+            board_frequency = parser.getint(section_name, OPTION_FREQUENCY, fallback=DEFAULT_PWM_FREQUENCY)
+
+            board_configs.append(BoardConfig(board_name, board_address, board_busnum, board_frequency, backend))
+            logging.info("Configured pwm board: '{}', address: 0x{:02x}, bus: {}".format(board_name, board_address,
+                                                                                     board_busnum))
+    return board_configs
+
+
+def get_gpio_monitor():
+    global gpio_monitor
+
+    if gpio_monitor is None:
+        gpio_monitor = GpioMonitor(gpio_poll_interval, create_gpio_backend(backend))
+    return gpio_monitor
+
+
+def get_sensor_scheduler():
+    global sensor_scheduler
+
+    if sensor_scheduler is None:
+        sensor_scheduler = SensorScheduler(DEFAULT_READ_WORKERS)
+    return sensor_scheduler
+
+
+def create_color_light(device_name, options):
+    device_id = options.get(OPTION_ID, fallback=None)
+    device_pins = pwm.parse_channel_ids(get_required_option(options, OPTION_PINS))
+    device_base_topic = options.get(OPTION_BASE_TOPIC, fallback=None)
+    device_value_range = options.getint(OPTION_VALUE_RANGE, fallback=None)
+    device_fade_duration = options.getfloat(OPTION_FADE_DURATION, fallback=DEFAULT_FADE_DURATION)
+    device_brightness_curve = create_brightness_curve(options)
+
+    device = ColorLightHandler(mqtt_conn, pwm, fade_scheduler, mqtt_basetopic=device_base_topic,
+                               id=device_id, channel_ids=device_pins, value_range=device_value_range,
+                               fade_duration=device_fade_duration, brightness_curve=device_brightness_curve,
+                               effects_engine=effects_engine, state_store=state_store)
+    logging.info("Created color-light device: '{}', pins: {}, topic: {}, id: {}".format(device_name, device_pins,
+                                                                                        device_base_topic,
+                                                                                        device_id))
+    return device
+
+
+def create_dimmable_light(device_name, options):
+    device_id = options.get(OPTION_ID, fallback=None)
+    device_pin = pwm.parse_channel_id(get_required_option(options, OPTION_PIN))
+    device_base_topic = options.get(OPTION_BASE_TOPIC, fallback=None)
+    device_value_range = options.getint(OPTION_VALUE_RANGE, fallback=None)
+    device_fade_duration = options.getfloat(OPTION_FADE_DURATION, fallback=DEFAULT_FADE_DURATION)
+    device_brightness_curve = create_brightness_curve(options)
+
+    device = DimmableLightHandler(mqtt_conn, pwm, fade_scheduler, mqtt_basetopic=device_base_topic,
+                                  id=device_id, channel_id=device_pin, value_range=device_value_range,
+                                  fade_duration=device_fade_duration, brightness_curve=device_brightness_curve,
+                                  effects_engine=effects_engine, state_store=state_store)
+    logging.info("Created dimmable-light device: '{}', pin: {}, topic: {}, id: {}".format(device_name, device_pin,
+                                                                                          device_base_topic,
+                                                                                          device_id))
+    return device
+
+
+def create_on_off(device_name, options):
+    device_id = options.get(OPTION_ID, fallback=None)
+    device_pin = pwm.parse_channel_id(get_required_option(options, OPTION_PIN))
+    device_base_topic = options.get(OPTION_BASE_TOPIC, fallback=None)
+
+    device = OnOffHandler(mqtt_conn, pwm, fade_scheduler, mqtt_basetopic=device_base_topic, id=device_id,
+                          channel_id=device_pin, state_store=state_store)
+    logging.info("Created on-off device: '{}', pins: {}, topic: {}, id: {}".format(device_name, device_pin,
+                                                                                   device_base_topic,
+                                                                                   device_id))
+    return device
+
+
+def create_pir(device_name, options):
+    device_id = options.get(OPTION_ID, fallback=None)
+    device_pin = options.getint("gpio", fallback=None)
+    device_base_topic = options.get(OPTION_BASE_TOPIC, fallback=None)
+    device_debounce = options.getfloat(OPTION_DEBOUNCE, fallback=DEFAULT_DEBOUNCE)
+    device_hold_time = options.getfloat(OPTION_HOLD_TIME, fallback=DEFAULT_HOLD_TIME)
+
+    device = PirHandler(mqtt_conn, get_gpio_monitor(), mqtt_basetopic=device_base_topic, id=device_id,
+                        pin=device_pin, debounce=device_debounce, hold_time=device_hold_time)
+    logging.info("Created pir device: '{}', gpio: {}, topic: {}, id: {}".format(device_name, device_pin,
+                                                                                device_base_topic,
+                                                                                device_id))
+    return device
+
+
+def create_dht(device_name, options):
+    device_id = options.get(OPTION_ID, fallback=None)
+    device_pin = options.getint("gpio", fallback=None)
+    device_base_topic = options.get(OPTION_BASE_TOPIC, fallback=None)
+    device_sensor = options.get(OPTION_SENSOR, fallback=SENSOR_DHT22).upper()
+    device_interval = options.getfloat(OPTION_INTERVAL, fallback=DEFAULT_INTERVAL)
+    device_temperature_threshold = options.getfloat(OPTION_TEMPERATURE_THRESHOLD,
+                                                    fallback=DEFAULT_TEMPERATURE_THRESHOLD)
+    device_humidity_threshold = options.getfloat(OPTION_HUMIDITY_THRESHOLD, fallback=DEFAULT_HUMIDITY_THRESHOLD)
+
+    device = DhtHandler(mqtt_conn, get_sensor_scheduler(), create_dht_backend(backend, device_sensor, device_pin),
+                        mqtt_basetopic=device_base_topic, id=device_id, interval=device_interval,
+                        temperature_threshold=device_temperature_threshold,
+                        humidity_threshold=device_humidity_threshold)
+    logging.info("Created dht device: '{}', sensor: {}, gpio: {}, topic: {}, id: {}".format(
+        device_name, device_sensor, device_pin, device_base_topic, device_id))
+    return device
+
+
+def get_member_devices(options):
+    member_names = [name.strip() for name in options.get(OPTION_MEMBERS, fallback="").split(",") if name.strip()]
+    members = []
+    for member_name in member_names:
+        member = device_registry.get_device(member_name)
+        if member is None or not hasattr(member, "apply_state"):
+            raise KeyError("Unknown or unsupported member device '" + member_name + "'.")
+        members.append((member_name, member))
+    return members
+
+
+def parse_scene_state(value, value_range):
+    """Parse a scene member state in the format 'power[, brightness[, color]]', e.g. 'ON, 80, 255;120;0'."""
+    parts = [part.strip() for part in value.split(",")]
+    power = parts[0].upper() == "ON"
+    brightness = float(parts[1]) / value_range if len(parts) > 1 and parts[1] else None
+    color = tuple(float(c) / value_range for c in parts[2].split(";")) if len(parts) > 2 and parts[2] else None
+    return SceneState(power, brightness, color)
+
+
+def create_group(device_name, options):
+    device_id = options.get(OPTION_ID, fallback=None)
+    device_base_topic = options.get(OPTION_BASE_TOPIC, fallback=None)
+    device_value_range = options.getint(OPTION_VALUE_RANGE, fallback=None)
+    device_members = get_member_devices(options)
+
+    device = GroupHandler(mqtt_conn, fade_scheduler, mqtt_basetopic=device_base_topic, id=device_id,
+                          members=tuple(member for _, member in device_members), value_range=device_value_range)
+    logging.info("Created group device: '{}', members: {}, topic: {}, id: {}".format(
+        device_name, [name for name, _ in device_members], device_base_topic, device_id))
+    return device
+
+
+def create_scene(device_name, options):
+    device_id = options.get(OPTION_ID, fallback=None)
+    device_base_topic = options.get(OPTION_BASE_TOPIC, fallback=None)
+    device_value_range = options.getint(OPTION_VALUE_RANGE, fallback=None)
+    device_fade_duration = options.getfloat(OPTION_FADE_DURATION, fallback=None)
+    device_member_states = [(member, parse_scene_state(options.get(name, fallback="ON"), device_value_range))
+                            for name, member in get_member_devices(options)]
+
+    device = SceneHandler(mqtt_conn, fade_scheduler, mqtt_basetopic=device_base_topic, id=device_id,
+                          member_states=tuple(device_member_states), duration=device_fade_duration)
+    logging.info("Created scene device: '{}', members: {}, topic: {}, id: {}".format(
+        device_name, len(device_member_states), device_base_topic, device_id))
+    return device
+
+
+def create_device_registry():
+    registry = DeviceRegistry()
+    registry.register_type(DEVICE_TYPE_COLOR_LIGHT, create_color_light)
+    registry.register_type(DEVICE_TYPE_DIMMABLE_LIGHT, create_dimmable_light)
+    registry.register_type(DEVICE_TYPE_ON_OFF, create_on_off)
+    registry.register_type(DEVICE_TYPE_PIR, create_pir)
+    registry.register_type(DEVICE_TYPE_DHT, create_dht)
+    registry.register_type(DEVICE_TYPE_GROUP, create_group)
+    registry.register_type(DEVICE_TYPE_SCENE, create_scene)
+    return registry
+
+
+def read_device_configs(parser):
+    """Return the options of all device sections by device name, along with the section name and device type."""
+    configs = {}
+    for section_name in parser.sections():
+        device_match = re.search('device:(.*)', section_name, re.IGNORECASE)
+        if device_match:
+            options = dict(parser[section_name])
+            configs[device_match.group(1)] = (section_name, options.get(OPTION_TYPE), options)
+    return configs
+
+
+def create_devices(parser, configs, device_names):
+    """Create the given devices, composite devices last. Returns the names of the devices in creation order."""
+    ordered_names = sorted(device_names, key=lambda name: configs[name][1] in COMPOSITE_DEVICE_TYPES)
+    for device_name in ordered_names:
+        section_name, device_type, _ = configs[device_name]
+        device_registry.create_device(device_name, device_type, parser[section_name])
+    return ordered_names
+
+
+def create_config_parser(configs):
+    """Build a parser holding the sections of the given device configs, e.g. to recreate devices of a previous
+    config. The options are already interpolated, so interpolation is disabled."""
+    parser = ConfigParser(interpolation=None)
+    for section_name, _, options in configs.values():
+        parser[section_name] = options
+    return parser
+
+
+def close_devices(device_names):
+    """Remove and close the given devices. Returns their states by device name and the channels they used."""
+    device_states = {}
+    released_channel_ids = set()
+    for device_name in device_names:
+        device = device_registry.remove_device(device_name)
+        if device is None:
+            continue
+        if hasattr(device, "get_channel_ids"):
+            released_channel_ids.update(device.get_channel_ids())
+        if hasattr(device, "get_state"):
+            device_states[device_name] = device.get_state()
+        if hasattr(device, "close"):
+            device.close()
+    return device_states, released_channel_ids
+
+
+def open_devices(parser, configs, device_names, device_states):
+    """Create the given devices and bring them to their state in device_states, or to their saved state."""
+    for device_name in create_devices(parser, configs, device_names):
+        device = device_registry.get_device(device_name)
+        if device is not None and device_name in device_states:
+            device.restore_state(device_states[device_name])
+        elif device is not None and state_store is not None and hasattr(device, "get_state_topic"):
+            saved_state = state_store.get(device.get_state_topic())
+            if saved_state is not None:
+                device.restore_state(saved_state)
+
+
+def turn_off_unused_channels(channel_ids):
+    """Turn off those of the given channels which no device uses, they would otherwise keep their last value."""
+    channel_ids = set(channel_ids)
+    for device in device_registry.get_devices().values():
+        if hasattr(device, "get_channel_ids"):
+            channel_ids.difference_update(device.get_channel_ids())
+    if channel_ids:
+        logging.info("Turning off channels no longer used by any device: %s", sorted(channel_ids))
+        pwm.set_pwm_channel_values({channel_id: 0 for channel_id in channel_ids}, ())
+
+
+def reload_devices():
+    """Re-read the config file and apply changes of the device sections. Only added, removed and changed devices
+    are touched; changed devices take over the state of their previous handler. Composite devices are always
+    recreated, as they hold references to their member devices. The mqtt session and the pwm outputs of untouched
+    devices are kept. If a device of the new config cannot be created, the previous devices are restored."""
+    global device_configs
 
     parser = ConfigParser()
-    parser.read(CONFIG_FILENAME)
+    parser.read(config_filename)
+    new_device_configs = read_device_configs(parser)
+
+    changed_names = {name for name in device_configs.keys() | new_device_configs.keys()
+                     if device_configs.get(name) != new_device_configs.get(name)}
+    if not changed_names:
+        logging.info("Config reloaded, no device changes")
+        return
+    composite_names = {name for name, (_, device_type, _) in device_configs.items()
+                       if device_type in COMPOSITE_DEVICE_TYPES}
+    composite_names |= {name for name, (_, device_type, _) in new_device_configs.items()
+                        if device_type in COMPOSITE_DEVICE_TYPES}
+    affected_names = changed_names | composite_names
+
+    device_states, released_channel_ids = close_devices(affected_names)
+    kept_states = {name: state for name, state in device_states.items()
+                   if name in new_device_configs and device_configs[name][1] == new_device_configs[name][1]}
+    try:
+        open_devices(parser, new_device_configs, affected_names & new_device_configs.keys(), kept_states)
+    except Exception:
+        logging.exception("Failed to create the devices of the reloaded config, restoring the previous devices")
+        _, failed_channel_ids = close_devices(affected_names)
+        open_devices(create_config_parser(device_configs), device_configs, affected_names & device_configs.keys(),
+                     device_states)
+        turn_off_unused_channels(failed_channel_ids)
+        return
+
+    turn_off_unused_channels(released_channel_ids)
+
+    logging.info("Config reloaded, added: %s, removed: %s, changed: %s",
+                 sorted(new_device_configs.keys() - device_configs.keys()),
+                 sorted(device_configs.keys() - new_device_configs.keys()),
+                 sorted(changed_names & device_configs.keys() & new_device_configs.keys()))
+    device_configs = new_device_configs
+
+
+def restore_device_states():
+    """Bring all devices to their saved state, so the outputs are restored before the broker is connected."""
+    if state_store is None:
+        return
+    for device in device_registry.get_devices().values():
+        if hasattr(device, "get_state_topic"):
+            saved_state = state_store.get(device.get_state_topic())
+            if saved_state is not None:
+                device.restore_state(saved_state)
+
+
+def initialize(filename: str = CONFIG_FILENAME, client_factory=None, general_overrides: dict = None):
+    """Set up all components and devices from the config file and start connecting to the broker. The client
+    factory replaces the paho client and the general overrides replace options of the general section (None
+    removes an option), which allows running a config against simulated hardware and a broker stand-in."""
+    global mqtt_conn, pwm, fade_scheduler, effects_engine, command_dispatcher, device_registry, metrics_server, backend, \
+        gpio_poll_interval, device_configs, config_watch_interval, state_store, config_filename
+
+    config_filename = filename
+    parser = ConfigParser()
+    parser.read(config_filename)
+    for option, value in (general_overrides or {}).items():
+        if value is None:
+            parser.remove_option(SECTION_GENERAL, option)
+        else:
+            parser.set(SECTION_GENERAL, option, value)
 
     mqtt_host = parser.get(SECTION_GENERAL, OPTION_MQTT_HOST)
     mqtt_port = parser.getint(SECTION_GENERAL, OPTION_MQTT_PORT)
     mqtt_protocol = parser.get(SECTION_GENERAL, OPTION_MQTT_PROTOCOL)
+    mqtt_version = parser.get(SECTION_GENERAL, OPTION_MQTT_VERSION, fallback=MQTT_VERSION_311)
+    mqtt_session_expiry = parser.getint(SECTION_GENERAL, OPTION_MQTT_SESSION_EXPIRY, fallback=DEFAULT_SESSION_EXPIRY)
+    mqtt_outbox_size = parser.getint(SECTION_GENERAL, OPTION_MQTT_OUTBOX_SIZE, fallback=DEFAULT_OUTBOX_SIZE)
+    mqtt_publish_window = parser.getfloat(SECTION_GENERAL, OPTION_MQTT_PUBLISH_WINDOW, fallback=DEFAULT_PUBLISH_WINDOW)
+    fade_frame_rate = parser.getfloat(SECTION_GENERAL, OPTION_FADE_FRAME_RATE, fallback=DEFAULT_FRAME_RATE)
+    effect_frame_rate = parser.getfloat(SECTION_GENERAL, OPTION_EFFECT_FRAME_RATE, fallback=DEFAULT_EFFECT_FRAME_RATE)
+    gpio_poll_interval = parser.getfloat(SECTION_GENERAL, OPTION_GPIO_POLL_INTERVAL, fallback=DEFAULT_POLL_INTERVAL)
+    backend = parser.get(SECTION_GENERAL, OPTION_BACKEND, fallback=BACKEND_HARDWARE)
+    output_process = parser.getboolean(SECTION_GENERAL, OPTION_OUTPUT_PROCESS, fallback=False)
+    output_frame_rate = parser.getfloat(SECTION_GENERAL, OPTION_OUTPUT_FRAME_RATE, fallback=DEFAULT_OUTPUT_FRAME_RATE)
+    metrics_host = parser.get(SECTION_GENERAL, OPTION_METRICS_HOST, fallback="127.0.0.1")
+    metrics_port = parser.getint(SECTION_GENERAL, OPTION_METRICS_PORT, fallback=None)
+    profiler_interval = parser.getfloat(SECTION_GENERAL, OPTION_PROFILER_INTERVAL, fallback=None)
+    config_watch_interval = parser.getfloat(SECTION_GENERAL, OPTION_CONFIG_WATCH_INTERVAL, fallback=None)
+    state_file = parser.get(SECTION_GENERAL, OPTION_STATE_FILE, fallback=DEFAULT_STATE_FILENAME)
+    state_write_delay = parser.getfloat(SECTION_GENERAL, OPTION_STATE_WRITE_DELAY, fallback=DEFAULT_WRITE_DELAY)
+    trace_file = parser.get(SECTION_GENERAL, OPTION_TRACE_FILE, fallback=None)
 
-    mqtt_conn = MqttConnector(mqtt_host, mqtt_port, mqtt_protocol)
-    pwm = PiPwm()
+    if metrics_port is not None:
+        profiler = SamplingProfiler(profiler_interval) if profiler_interval is not None else None
+        metrics_server = MetricsServer(metrics_host, metrics_port, profiler=profiler)
 
-    for section_name in parser.sections():
-        device_match = re.search('device:(.*)', section_name, re.IGNORECASE)
-        if device_match:
-            device_name = device_match.group(1)
-            device_type = parser.get(section_name, OPTION_TYPE, fallback=None)
-
-            if device_type == DEVICE_TYPE_COLOR_LIGHT:
-                device_id = parser.get(section_name, OPTION_ID, fallback=None)
-                device_pins = literal_eval(parser.get(section_name, OPTION_PINS, fallback=None))
-                device_base_topic = parser.get(section_name, OPTION_BASE_TOPIC, fallback=None)
-                device_value_range = parser.getint(section_name, OPTION_VALUE_RANGE, fallback=None)
-
-                ColorLightHandler(mqtt_conn, pwm, mqtt_basetopic=device_base_topic,
-                                  id=device_id, channel_ids=device_pins, value_range=device_value_range)
-                logging.info(
-                    "Created color-light device: '{}', pins: {}, topic: {}, id: {}".format(device_name, device_pins,
-                                                                                           device_base_topic,
-                                                                                           device_id))
-
-            if device_type == DEVICE_TYPE_DIMMABLE_LIGHT:
-                device_id = parser.get(section_name, OPTION_ID, fallback=None)
-                device_pin = parser.getint(section_name, OPTION_PIN, fallback=None)
-                device_base_topic = parser.get(section_name, OPTION_BASE_TOPIC, fallback=None)
-                device_value_range = parser.getint(section_name, OPTION_VALUE_RANGE, fallback=None)
-
-                DimmableLightHandler(mqtt_conn, pwm, mqtt_basetopic=device_base_topic,
-                                     id=device_id, channel_id=device_pin, value_range=device_value_range)
-                logging.info(
-                    "Created dimmable-light device: '{}', pin: {}, topic: {}, id: {}".format(device_name, device_pin,
-                                                                                             device_base_topic,
-                                                                                             device_id))
-
-            if device_type == DEVICE_TYPE_ON_OFF:
-                device_id = parser.get(section_name, OPTION_ID, fallback=None)
-                device_pin = parser.getint(section_name, OPTION_PIN, fallback=None)
-                device_base_topic = parser.get(section_name, OPTION_BASE_TOPIC, fallback=None)
-
-                OnOffHandler(mqtt_conn, pwm, mqtt_basetopic=device_base_topic, id=device_id, channel_id=device_pin)
-                logging.info("Created on-off device: '{}', pins: {}, topic: {}, id: {}".format(device_name, device_pin,
-                                                                                               device_base_topic,
-                                                                                               device_id))
-
-            if device_type == DEVICE_TYPE_PIR:
-                device_id = parser.get(section_name, OPTION_ID, fallback=None)
-                device_pin = parser.getint(section_name, "gpio", fallback=None)
-                device_base_topic = parser.get(section_name, OPTION_BASE_TOPIC, fallback=None)
-
-                PirHandler(mqtt_conn, mqtt_basetopic=device_base_topic, id=device_id, pin=device_pin)
-                logging.info("Created pir device: '{}', gpio: {}, topic: {}, id: {}".format(device_name, device_pin,
-                                                                                            device_base_topic,
-                                                                                            device_id))
+    command_dispatcher = CommandDispatcher()
+    trace_recorder = TraceRecorder(trace_file) if trace_file else None
+    connector_options = {"client_factory": client_factory} if client_factory is not None else {}
+    mqtt_conn = MqttConnector(mqtt_host, mqtt_port, mqtt_protocol, command_dispatcher, mqtt_version,
+                              mqtt_session_expiry, mqtt_outbox_size, mqtt_publish_window, trace_recorder,
+                              **connector_options)
+    if output_process:
+        pwm = SharedMemoryPwm(read_board_configs(parser), backend, output_frame_rate)
+    else:
+        pwm = PiPwm(read_board_configs(parser), backend)
+    fade_scheduler = FadeScheduler(pwm, fade_frame_rate)
+    effects_engine = EffectsEngine(pwm, effect_frame_rate)
+    device_registry = create_device_registry()
+    state_store = StateStore(state_file, state_write_delay) if state_file else None
+
+    device_configs = read_device_configs(parser)
+    create_devices(parser, device_configs, device_configs.keys())
+    restore_device_states()
+
+    # all devices are set up and registered their topics, so they get subscribed in one batch once connected
+    mqtt_conn.connect()
+
+
+def get_config_mtime():
+    try:
+        return os.stat(config_filename).st_mtime
+    except OSError:
+        return None
+
+
+def handle_reload(signum, frame):
+    # only set a flag, the main loop is woken up through the signal wakeup fd; setting an Event here could deadlock
+    # with the main thread waiting on it
+    global reload_requested
+    reload_requested = True
+
+
+def handle_terminate(signum, frame):
+    # SIGTERM would end the process without running the atexit handlers, which write the trace and the states
+    raise SystemExit(0)
 
 
 if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, handle_terminate)
     initialize()
 
-    while True:
-        time.sleep(2)
+    # the config is reloaded on SIGHUP, and additionally on file changes if a watch interval is configured
+    wakeup_receiver, wakeup_sender = socket.socketpair()
+    wakeup_sender.setblocking(False)
+    signal.set_wakeup_fd(wakeup_sender.fileno())
+    signal.signal(signal.SIGHUP, handle_reload)
+    config_mtime = get_config_mtime()
+    try:
+        while True:
+            if select.select([wakeup_receiver], [], [], config_watch_interval)[0]:
+                wakeup_receiver.recv(4096)
+            current_config_mtime = get_config_mtime()
+            if reload_requested or current_config_mtime != config_mtime:
+                reload_requested = False
+                config_mtime = current_config_mtime
+                try:
+                    reload_devices()
+                except Exception:
+                    logging.exception("Failed to reload config")
+    finally:
+        # write state changes still waiting for the write delay before the process ends
+        if state_store is not None:
+            state_store.flush()
@@ -0,0 +1,83 @@
+import threading
+import unittest
+
+from core.command_dispatcher import CommandDispatcher
+from core.command_schema import merge_set_payloads, parse_set_command
+
+WAIT_TIMEOUT = 5
+SET_TOPIC = "home/lights/kitchen/set"
+BLOCKING_TOPIC = "home/lights/hallway/set"
+
+
+class CommandDispatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = CommandDispatcher()
+        self.release_worker = threading.Event()
+        self.worker_blocked = threading.Event()
+        self.handled_payloads = []
+        self.handled = threading.Condition()
+
+    def tearDown(self):
+        self.release_worker.set()
+
+    def block_worker(self):
+        """Keep the worker busy with a command of another topic, so following commands stay pending."""
+        def blocking_callback(payload):
+            self.worker_blocked.set()
+            self.release_worker.wait(WAIT_TIMEOUT)
+
+        self.dispatcher.dispatch(BLOCKING_TOPIC, b"{}", (blocking_callback,))
+        self.assertTrue(self.worker_blocked.wait(WAIT_TIMEOUT))
+
+    def record_payload(self, payload):
+        with self.handled:
+            self.handled_payloads.append(payload)
+            self.handled.notify_all()
+
+    def wait_for_payloads(self, count):
+        with self.handled:
+            self.assertTrue(self.handled.wait_for(lambda: len(self.handled_payloads) >= count, WAIT_TIMEOUT))
+            return list(self.handled_payloads)
+
+    def test_pending_command_is_superseded(self):
+        self.block_worker()
+        self.dispatcher.dispatch(SET_TOPIC, b"1", (self.record_payload,))
+        self.dispatcher.dispatch(SET_TOPIC, b"2", (self.record_payload,))
+        self.release_worker.set()
+
+        self.assertEqual([b"2"], self.wait_for_payloads(1))
+        self.assertEqual(1, self.dispatcher.get_statistics()["coalesced"])
+
+    def test_partial_set_commands_are_merged(self):
+        self.dispatcher.set_merge_function(SET_TOPIC, merge_set_payloads)
+        self.block_worker()
+        self.dispatcher.dispatch(SET_TOPIC, b'{"state": "ON"}', (self.record_payload,))
+        self.dispatcher.dispatch(SET_TOPIC, b'{"brightness": 200}', (self.record_payload,))
+        self.release_worker.set()
+
+        payloads = self.wait_for_payloads(1)
+        self.assertEqual(1, len(payloads))
+        command = parse_set_command(payloads[0], 255)
+        self.assertTrue(command.power)
+        self.assertAlmostEqual(200 / 255, command.brightness)
+
+    def test_newer_set_fields_take_precedence(self):
+        self.dispatcher.set_merge_function(SET_TOPIC, merge_set_payloads)
+        self.block_worker()
+        self.dispatcher.dispatch(SET_TOPIC, b'{"state": "ON", "brightness": 50}', (self.record_payload,))
+        self.dispatcher.dispatch(SET_TOPIC, b'{"state": "OFF"}', (self.record_payload,))
+        self.release_worker.set()
+
+        command = parse_set_command(self.wait_for_payloads(1)[0], 255)
+        self.assertFalse(command.power)
+        self.assertAlmostEqual(50 / 255, command.brightness)
+
+
+class MergeSetPayloadsTest(unittest.TestCase):
+    def test_invalid_payload_keeps_newer_payload(self):
+        self.assertEqual(b'{"state": "ON"}', merge_set_payloads(b"not json", b'{"state": "ON"}'))
+        self.assertEqual(b"[1]", merge_set_payloads(b'{"state": "ON"}', b"[1]"))
+
+
+if __name__ == "__main__":
+    unittest.main()